@@ -0,0 +1,222 @@
+#
+# Asyncio variants of the Elster bus and MQTT client
+#
+
+import asyncio
+import contextlib
+import time
+
+import can
+import paho.mqtt.client as mqtt
+
+from .elster2mqtt import (ChangeFilter,
+                          DerivedValues,
+                          ElsterBus,
+                          ElsterReadTimedOut,
+                          ElsterReceiverUnavailable,
+                          ElsterRegister,
+                          ElsterValue,
+                          MqttClient,
+                          Publisher,
+                          response_time)
+
+
+class AsyncElsterBus(ElsterBus):
+    """Asyncio Elster bus class"""
+    def __init__(self, config, simulate=False, interface="socketcan", recorder=None):
+        super().__init__(config, simulate=simulate, interface=interface, recorder=recorder)
+        self.reader = None
+        self.task = None
+
+    async def __aenter__(self):
+        if not self.simulate:
+            self.bus = can.Bus(channel=self.channel, interface=self.interface, can_filters=self.can_filters())
+            self.reader = can.AsyncBufferedReader()
+            self.notifier = can.Notifier(self.bus, [self.reader], loop=asyncio.get_running_loop())
+            self.task = asyncio.create_task(self._receive())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+        if self.notifier:
+            self.notifier.stop()
+        if self.bus:
+            self.bus.shutdown()
+
+    async def _receive(self):
+        """Feed received frames to the dispatcher"""
+        async for m in self.reader:
+            self.dispatcher.on_message_received(m)
+            if self.recorder:
+                self.recorder.record(m)
+
+    async def read(self, name=None, receiver=None, register=None, fmt=None, timeout=None):
+        if name in self.composites:
+            composite = self.composites[name]
+            parts = await asyncio.gather(*(self.read(receiver=p.receiver, register=p.register, fmt=p.fmt,
+                                                     timeout=timeout) for p in composite.parts))
+            return composite.value(parts)
+
+        # Look up or construct the read request
+        if name:
+            reg = self.lookup(name)
+        else:
+            reg = ElsterRegister(self.sender, receiver, register, fmt=fmt, formats=self.formats)
+        receiver, register = reg.receiver, reg.register
+
+        if self.simulate:
+            return ElsterValue(receiver, self.sender, register, 12345, timestamp=time.monotonic()).with_register(reg)
+
+        # Send the read request and wait for the response
+        timeout = self.admit(receiver, timeout)
+        health = self.receiver_health(receiver)
+        fut = self.request(reg)
+        try:
+            msg = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(fut)), timeout)
+        except asyncio.TimeoutError:
+            self.dispatcher.forget(receiver, register, fut)
+            health.failure(time.monotonic())
+            raise ElsterReadTimedOut("Timed out waiting for a response") from None
+        health.success(response_time(fut))
+        return msg.with_register(reg)
+
+    async def read_many(self, names, window=None, timeout=None):
+        """Read the given names with up to 'window' requests in flight
+
+        Names that time out or whose receiver is unavailable are reported and
+        left out of the returned results.
+        """
+        sem = asyncio.Semaphore(window or self.window)
+        results = {}
+
+        async def read_one(name):
+            async with sem:
+                try:
+                    results[name] = await self.read(name, timeout=timeout)
+                except (ElsterReadTimedOut, ElsterReceiverUnavailable) as e:
+                    print(f"{name}: {e}")
+
+        await asyncio.gather(*(read_one(name) for name in names))
+        return results
+
+
+class AsyncMqttClient(MqttClient):
+    """Asyncio MQTT client class
+
+    Drives the paho client from the running event loop through its socket
+    callbacks instead of a background network thread.
+    """
+    def __init__(self, config, simulate=False):
+        super().__init__(config, simulate=simulate)
+        self.loop = None
+        self.misc = None
+        self.inflight = {}
+
+    async def __aenter__(self):
+        if not self.simulate:
+            self.loop = asyncio.get_running_loop()
+            connected = self.loop.create_future()
+
+            self.client = mqtt.Client()
+            self.client.on_socket_open = self._on_socket_open
+            self.client.on_socket_close = self._on_socket_close
+            self.client.on_socket_register_write = self._on_socket_register_write
+            self.client.on_socket_unregister_write = self._on_socket_unregister_write
+            self.client.on_connect = lambda client, userdata, flags, rc: connected.done() or connected.set_result(rc)
+            self.client.on_publish = self._on_publish
+
+            self.client.connect(self.server, self.port)
+            self.misc = self.loop.create_task(self._misc_loop())
+            await connected
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.client:
+            self.client.disconnect()
+        if self.misc:
+            self.misc.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.misc
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def _on_publish(self, client, userdata, mid):
+        fut = self.inflight.pop(mid, None)
+        if fut and not fut.done():
+            fut.set_result(mid)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def publish(self, topic, value):
+        if self.topic_prefix:
+            topic = f"{self.topic_prefix}{topic}"
+        print(f"Publish: {topic}: {value}")
+        if not self.simulate:
+            fut = self.loop.create_future()
+            info = self.client.publish(topic, value)
+            if info.is_published():
+                return
+            self.inflight[info.mid] = fut
+            await fut
+
+
+class PublishTasks:
+    """Adapter that lets the Publisher drive an AsyncMqttClient
+
+    Each publish is started as a task, drain() waits for all of them.
+    """
+    def __init__(self, mqttc):
+        self.mqttc = mqttc
+        self.tasks = []
+
+    def publish(self, topic, value):
+        self.tasks.append(asyncio.ensure_future(self.mqttc.publish(topic, value)))
+
+    async def drain(self):
+        tasks, self.tasks = self.tasks, []
+        await asyncio.gather(*tasks)
+
+
+async def amain(config, args, interface="socketcan", recorder=None):
+    """Asyncio entry point"""
+    async with (AsyncElsterBus(config, simulate=args.simulate_can, interface=interface, recorder=recorder) as elster,
+                AsyncMqttClient(config, simulate=args.simulate_mqtt) as mqttc):
+        if args.name:
+            msg = await elster.read(args.name)
+            print(f"{args.name} ({msg.sender:03x}.{msg.register:04x}): {msg.formatted_value}")
+            return
+
+        if args.index:
+            rec, reg = args.index.split(".")
+            msg = await elster.read(receiver=int(rec, 16), register=int(reg, 16))
+            print(f"UNBEKANNT ({args.index}): {msg.value}")
+            return
+
+        changes = ChangeFilter(config, state_file=config["mqtt"].get("state_file"))
+        tasks = PublishTasks(mqttc)
+        publisher = Publisher(tasks, config, changes=changes, derived=DerivedValues(config, elster.names))
+        msgs = await elster.read_many(elster.names)
+        for name in elster.names:
+            msg = msgs.get(name)
+            if msg is None:
+                continue
+            print(f"{name} ({msg.sender:03x}.{msg.register:04x}): {msg.formatted_value}")
+            publisher.publish(name, msg.formatted_value)
+        publisher.flush()
+        await tasks.drain()
+        changes.save()
@@ -0,0 +1,231 @@
+#
+# End-to-end polling cycle benchmark against the simulator
+#
+
+import argparse
+import contextlib
+import io
+import json
+import socket
+import threading
+import time
+from importlib import metadata
+
+import can
+import yaml
+
+from .elster2mqtt import ElsterBus, MqttClient, Publisher, ReceiverHealth, poll
+from .simulator import ElsterSimulator
+
+
+class RecordingHealth(ReceiverHealth):
+    """Receiver health class that records all measured response times"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = []
+
+    def success(self, rtt=None):
+        if rtt is not None:
+            self.samples.append(rtt)
+        super().success(rtt)
+
+
+class CountingPublisher(Publisher):
+    """Publisher class that counts the published values"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = 0
+
+    def publish(self, name, value, stream=None):
+        self.values += 1
+        super().publish(name, value, stream=stream)
+
+
+class LoopbackBroker:
+    """Minimal MQTT broker stand-in on the loopback interface
+
+    Accepts connections, answers CONNECT and PINGREQ and discards everything
+    else, so that the MQTT client does the real protocol and socket work.
+    Only QoS 0 publishes are supported, since they aren't acknowledged.
+    """
+    CONNECT = 0x10
+    PUBLISH = 0x30
+    PINGREQ = 0xc0
+    DISCONNECT = 0xe0
+
+    def __init__(self):
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.publishes = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        threading.Thread(target=self._accept, name="LoopbackBroker", daemon=True).start()
+
+    def stop(self):
+        self.sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rb") as fh:
+            while True:
+                header = fh.read(1)
+                if not header:
+                    return
+                # Remaining length, variable length encoded
+                length, shift = 0, 0
+                while True:
+                    b = fh.read(1)
+                    if not b:
+                        return
+                    length |= (b[0] & 0x7f) << shift
+                    shift += 7
+                    if not b[0] & 0x80:
+                        break
+                fh.read(length)
+
+                packet = header[0] & 0xf0
+                if packet == self.CONNECT:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif packet == self.PUBLISH:
+                    self.publishes += 1
+                elif packet == self.PINGREQ:
+                    conn.sendall(b"\xd0\x00")
+                elif packet == self.DISCONNECT:
+                    return
+
+
+class FrameCounter(can.Listener):
+    """Count all frames on the bus"""
+    def __init__(self):
+        self.frames = 0
+
+    def on_message_received(self, msg):
+        self.frames += 1
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[round(p / 100 * (len(values) - 1))]
+
+
+def summary(values):
+    return {"mean": sum(values) / len(values), "min": min(values), "max": max(values)}
+
+
+def version():
+    try:
+        return metadata.version("elster2mqtt")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def run_benchmark(config, cycles=5, channel="elster2mqtt-benchmark"):
+    """Run 'cycles' polling cycles against the simulator and return the results
+
+    Values are published with the real MQTT client to a LoopbackBroker. The
+    CPU time is that of the whole process, so it includes the simulator and
+    the broker stand-in.
+    """
+    health = {}
+
+    with contextlib.ExitStack() as stack:
+        broker = stack.enter_context(LoopbackBroker())
+        config = dict(config, can=dict(config["can"], interface=channel),
+                      mqtt=dict(config["mqtt"], server="127.0.0.1", port=str(broker.port)))
+        stack.enter_context(ElsterSimulator(config, interface="virtual"))
+        elster = stack.enter_context(ElsterBus(config, interface="virtual"))
+        mqttc = stack.enter_context(MqttClient(config))
+        monitor = stack.enter_context(can.Bus(channel=channel, interface="virtual"))
+        counter = FrameCounter()
+        stack.callback(can.Notifier(monitor, [counter]).stop)
+
+        for receiver in elster.receivers:
+            health[receiver] = elster.health[receiver] = RecordingHealth(
+                elster.breaker_threshold, elster.breaker_reset, elster.timeout_min, elster.timeout_max,
+                elster.timeout_initial)
+        publisher = CountingPublisher(mqttc, config)
+
+        cycle_times = []
+        cpu_times = []
+        for _ in range(cycles):
+            start, start_cpu = time.perf_counter(), time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                poll(elster, publisher)
+            cycle_times.append(time.perf_counter() - start)
+            cpu_times.append(time.process_time() - start_cpu)
+
+    latencies = [rtt for h in health.values() for rtt in h.samples]
+    return {
+        "version": version(),
+        "timestamp": time.time(),
+        "cycles": cycles,
+        "names": len(elster.names),
+        "window": elster.window,
+        "cycle_time": summary(cycle_times),
+        "cpu_time": summary(cpu_times),
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 90, 99, 100)},
+        "published_values": publisher.values,
+        "frames": counter.frames,
+        "frames_per_value": counter.frames / publisher.values if publisher.values else None,
+    }
+
+
+def compare(old, new):
+    """Return report lines comparing two benchmark results"""
+    lines = []
+    for key, path in (("cycle time", ("cycle_time", "mean")), ("cpu time", ("cpu_time", "mean")),
+                      ("p50 latency", ("latency", "p50")), ("p99 latency", ("latency", "p99")),
+                      ("frames per value", ("frames_per_value",))):
+        a, b = old, new
+        for k in path:
+            a, b = a.get(k) if a else None, b.get(k) if b else None
+        if a and b:
+            lines.append(f"{key}: {a:.4f} -> {b:.4f} ({(b - a) / a * 100:+.1f}%)")
+    return lines
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="Configuration file in YAML format")
+    parser.add_argument("--cycles", type=int, default=5, help="Number of polling cycles")
+    parser.add_argument("--output", help="Write the results as JSON to the given file")
+    parser.add_argument("--compare", help="Compare the results with those in the given JSON file")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fh:
+        config = yaml.load(fh, Loader=yaml.BaseLoader)
+
+    results = run_benchmark(config, cycles=args.cycles)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            old = json.load(fh)
+        print(f"Compared to {old['version']}:")
+        for line in compare(old, results):
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
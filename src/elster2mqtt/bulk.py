@@ -0,0 +1,103 @@
+#
+# Vectorised bulk decoding of frame logs with NumPy
+#
+
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .elster2mqtt import TYPE_RESPONSE, get_format
+from .recorder import RECORD
+
+# NumPy equivalent of recorder.RECORD
+if np is not None:
+    FRAME_DTYPE = np.dtype([("timestamp", "<f8"), ("arbitration_id", "<u4"), ("dlc", "u1"), ("pad", "V3"),
+                            ("data", "u1", (8,))])
+else:
+    FRAME_DTYPE = None
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("Bulk decoding requires NumPy, install it with 'pip install elster2mqtt[bulk]'")
+
+
+def load_frames(path):
+    """Memory-map a FrameRecorder log as a structured array"""
+    require_numpy()
+    count = os.path.getsize(path) // RECORD.size
+    if not count:
+        return np.zeros(0, dtype=FRAME_DTYPE)
+    return np.memmap(path, dtype=FRAME_DTYPE, mode="r", shape=(count,))
+
+
+def decode_frames(frames):
+    """Decode a structured array of frames into columns
+
+    Vectorised equivalent of decode_elster_frame(). Returns a dict of the
+    columns timestamp, sender, type, receiver, register, value, has_value and
+    valid, where valid is false for frames that aren't Elster frames.
+    """
+    require_numpy()
+    data = frames["data"].astype(np.uint16)
+    dlc = frames["dlc"]
+    b0, b1, b2 = data[:, 0], data[:, 1], data[:, 2]
+    word34 = (data[:, 3] << 8) | data[:, 4]
+    word56 = (data[:, 5] << 8) | data[:, 6]
+
+    long = b2 == 0xfa
+    long7 = (dlc == 7) & long
+    long5 = (dlc == 5) & long
+    short = ((dlc == 7) | (dlc == 5)) & ~long
+    short3 = (dlc == 3) & ~long
+
+    return {
+        "timestamp": frames["timestamp"],
+        "sender": frames["arbitration_id"],
+        "type": b0 & 0x0f,
+        "receiver": ((b0 & 0xf0) << 3) | (b1 & 0x7f),
+        "register": np.where(long7 | long5, word34, b2),
+        "value": np.where(long7, word56, np.where(short, word34, 0)).astype(np.int32),
+        "has_value": long7 | short,
+        "valid": long7 | long5 | short | short3,
+    }
+
+
+def format_column(values, fmt):
+    """Convert a column of raw values to the given format"""
+    return convert_column(values, get_format(fmt))
+
+
+def convert_column(values, converter):
+    """Convert a column of raw values with the given format converter
+
+    Converters built only from arithmetic and bit operations are applied to
+    the whole column at once. Others, like enum and bits formats, fall back
+    to converting the values one by one into an object column.
+    """
+    require_numpy()
+    if converter is None:
+        return values
+    try:
+        result = converter(values)
+    except (TypeError, ValueError):
+        result = None
+    if isinstance(result, np.ndarray) and result.shape == values.shape:
+        return result
+    result = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values.tolist()):
+        result[i] = converter(value)
+    return result
+
+
+def bulk_values(columns, elster):
+    """Return {name: (timestamps, values)} of the responses for the bus' configured names"""
+    responses = columns["valid"] & columns["has_value"] & (columns["type"] == TYPE_RESPONSE)
+    results = {}
+    for name, reg in elster.registers.items():
+        mask = responses & (columns["sender"] == reg.receiver) & (columns["register"] == reg.register)
+        results[name] = (columns["timestamp"][mask], convert_column(columns["value"][mask], reg.convert))
+    return results
@@ -3,8 +3,21 @@
 #
 
 import argparse
+import ast
+import asyncio
+import contextlib
+import heapq
+import itertools
 import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import can
 import paho.mqtt.client as mqtt
@@ -13,6 +26,9 @@ import yaml
 TYPE_REQUEST = 0x01
 TYPE_RESPONSE = 0x02
 
+# Value returned for registers the receiver doesn't support
+NO_VALUE = 0x8000
+
 
 class ElsterError(Exception):
     pass
@@ -34,6 +50,18 @@ class ElsterReadTimedOut(ElsterError):
     pass
 
 
+class ElsterReceiverUnavailable(ElsterError):
+    pass
+
+
+class ElsterInvalidFormat(ElsterError):
+    pass
+
+
+class ElsterInvalidExpression(ElsterError):
+    pass
+
+
 def encode_elster_data(receiver, register, value=None):
     """Encode Elster request/respone frame data"""
     if value is None:
@@ -75,84 +103,629 @@ def decode_elster_data(data, size=7):
     return msg_type, receiver, register, value
 
 
-class ElsterMessage(can.Message):
-    """Elster message class"""
-    def __init__(self, sender=None, receiver=None, register=None, msg=None, fmt=None):
-        if msg:
-            self.fmt = fmt
-            self.sender = msg.arbitration_id
-            self.type, self.receiver, self.register, self.value = decode_elster_data(msg.data)
-            data = msg.data
+# Frame layouts: type/receiver high bits, receiver low bits, 0xfa or short
+# register, then register and/or value in big endian
+FRAME_7 = struct.Struct(">BBBHH")
+FRAME_5 = struct.Struct(">BBBH")
+FRAME_3 = struct.Struct(">BBB")
+
+
+def encode_elster_frame(receiver, register, value=None):
+    """Encode Elster request/response frame data as bytes"""
+    b0 = (receiver >> 3) & 0xf0
+    b1 = receiver & 0x7f
+    if value is None:
+        return FRAME_5.pack(b0 | TYPE_REQUEST, b1, 0xfa, register & 0xffff)
+    return FRAME_7.pack(b0 | TYPE_RESPONSE, b1, 0xfa, register & 0xffff, value & 0xffff)
+
+
+def decode_elster_frame(data):
+    """Decode Elster request/response frame data without raising
+
+    Works directly on bytes, bytearray or memoryview data, lists of byte
+    values are converted first. Returns (msg_type, receiver, register,
+    value), or None if the data isn't a valid Elster frame. Supports both the
+    long form, where byte 2 is 0xfa and the register is in bytes 3-4, and the
+    short form, where byte 2 is the register itself and the value, if any, is
+    in bytes 3-4.
+    """
+    if isinstance(data, (list, tuple)):
+        try:
+            data = bytes(data)
+        except (TypeError, ValueError):
+            return None
+    size = len(data)
+    if size == 7:
+        b0, b1, b2, register, value = FRAME_7.unpack_from(data)
+        if b2 != 0xfa:
+            register, value = b2, register
+    elif size == 5:
+        b0, b1, b2, register = FRAME_5.unpack_from(data)
+        if b2 == 0xfa:
+            value = None
         else:
-            self.sender = sender
-            self.receiver = receiver
-            self.register = register
-            self.fmt = fmt
-            self.type = TYPE_REQUEST
-            self.value = None
-            data = encode_elster_data(self.receiver, self.register)
-        super().__init__(arbitration_id=self.sender, data=data, is_extended_id=False)
+            register, value = b2, register
+    elif size == 3:
+        b0, b1, register = FRAME_3.unpack_from(data)
+        if register == 0xfa:
+            return None
+        value = None
+    else:
+        return None
+    return b0 & 0x0f, ((b0 & 0xf0) << 3) | (b1 & 0x7f), register, value
+
+
+def to_signed(value):
+    """Interpret a 16-bit value as two's complement"""
+    return value - ((value & 0x8000) << 1)
+
+
+def swap_bytes(value):
+    return ((value & 0xff) << 8) | (value >> 8)
+
+
+# Format converters, keyed by format name. The built-in ones only use
+# arithmetic and bit operations so that they work on NumPy arrays too.
+FORMATS = {
+    "dec_val": lambda v: v / 10.0,
+    "mil_val": lambda v: v / 1000.0,
+    "little_endian": swap_bytes,
+    "signed": to_signed,
+    "signed_dec_val": lambda v: to_signed(v) / 10.0,
+    "signed_mil_val": lambda v: to_signed(v) / 1000.0,
+}
+
+
+def get_format(fmt, formats=FORMATS):
+    """Return the converter for the given format, or None for raw values"""
+    if not fmt:
+        return None
+    converter = formats.get(fmt)
+    if converter is None:
+        raise ElsterInvalidFormat(f"Invalid format: {fmt}")
+    return converter
+
+
+def make_format(spec, formats=FORMATS):
+    """Build a format converter from a format declaration in the config
+
+    The raw value is first converted with the optional 'base' format, looked
+    up in 'formats', then interpreted as two's complement if 'signed' is true,
+    then multiplied by 'scale' and 'offset' is added. Finally it is mapped
+    through 'enum' (value to name) or turned into the list of names of the set
+    bits in 'bits' (bit number to name).
+    """
+    base = get_format(spec.get("base"), formats)
+    signed = spec.get("signed", "false") == "true"
+    scale = float(spec["scale"]) if "scale" in spec else None
+    offset = float(spec["offset"]) if "offset" in spec else None
+    enum = {int(k, 0): v for k, v in spec.get("enum", {}).items()}
+    bits = [(1 << int(k, 0), v) for k, v in spec.get("bits", {}).items()]
+
+    def convert(value):
+        if base:
+            value = base(value)
+        if signed:
+            value = to_signed(value)
+        if scale is not None:
+            value = value * scale
+        if offset is not None:
+            value = value + offset
+        if enum:
+            return enum.get(value, value)
+        if bits:
+            return [name for mask, name in bits if value & mask]
+        return value
+
+    return convert
+
+
+class ElsterValue:
+    """Elster value class
+
+    A compact record of a decoded response with its monotonic receive time
+    and the converter of its format, if any.
+    """
+    __slots__ = ("type", "sender", "receiver", "register", "value", "timestamp", "fmt", "convert")
+
+    def __init__(self, sender, receiver, register, value, timestamp=0.0, fmt=None, type=TYPE_RESPONSE,
+                 convert=None):
+        self.type = type
+        self.sender = sender
+        self.receiver = receiver
+        self.register = register
+        self.value = value
+        self.timestamp = timestamp
+        self.fmt = fmt
+        self.convert = convert
+
+    @classmethod
+    def from_frame(cls, arbitration_id, data, timestamp=0.0):
+        """Decode a frame, return None if it isn't a valid Elster frame"""
+        decoded = decode_elster_frame(data)
+        if decoded is None:
+            return None
+        msg_type, receiver, register, value = decoded
+        return cls(arbitration_id, receiver, register, value, timestamp=timestamp, type=msg_type)
+
+    def with_format(self, fmt, formats=FORMATS):
+        """Return a copy with the given format, looked up in 'formats'"""
+        return self._with_converter(fmt, get_format(fmt, formats))
+
+    def with_register(self, reg):
+        """Return a copy with the register's format"""
+        return self._with_converter(reg.fmt, reg.convert)
+
+    def _with_converter(self, fmt, convert):
+        return ElsterValue(self.sender, self.receiver, self.register, self.value, timestamp=self.timestamp,
+                           fmt=fmt, type=self.type, convert=convert)
 
     @property
     def formatted_value(self):
-        if not self.fmt:
+        if self.convert is None:
             return self.value
-        return {
-            "dec_val": self.value / 10.0,
-            "mil_val": self.value / 1000.0,
-            "little_endian": ((self.value & 0xff) << 8) | (self.value >> 8),
-        }[self.fmt]
+        return self.convert(self.value)
+
+    def __repr__(self):
+        return (f"ElsterValue({self.sender:03x} -> {self.receiver:03x}, {self.register:04x}: {self.value}, "
+                f"fmt={self.fmt})")
+
+
+class ElsterRegister:
+    """Elster register class
+
+    A register compiled from its configuration entry, with the ready-to-send
+    read request frame.
+    """
+    __slots__ = ("name", "receiver", "register", "fmt", "convert", "max_age", "request")
+
+    def __init__(self, sender, receiver, register, fmt=None, max_age=None, name=None, formats=FORMATS):
+        self.name = name
+        self.receiver = receiver
+        self.register = register
+        self.fmt = fmt
+        self.convert = get_format(fmt, formats)
+        self.max_age = max_age
+        self.request = can.Message(arbitration_id=sender, data=encode_elster_frame(receiver, register),
+                                   is_extended_id=False)
+
+
+# Composite value combine functions, keyed by name. They take the list of
+# formatted part values.
+COMBINERS = {
+    "sum": sum,
+    # Counters split into a kWh and a MWh part
+    "kwh_mwh": lambda parts: parts[0] + parts[1] * 1000,
+    # Counters split into a Wh and a kWh part
+    "wh_kwh": lambda parts: parts[0] / 1000 + parts[1],
+}
+
+
+class ElsterComposite:
+    """Elster composite value class
+
+    A value that is split across several registers and combined from them.
+    """
+    def __init__(self, sender, config, formats=FORMATS):
+        self.name = config["name"]
+        self.parts = []
+        for part in config["parts"]:
+            if isinstance(part, str):
+                part = {"index": part}
+            rec, reg = part["index"].split(".")
+            self.parts.append(ElsterRegister(sender, int(rec, 16), int(reg, 16), fmt=part.get("format"),
+                                             formats=formats))
+        combine = config.get("combine", "sum")
+        self.combine = COMBINERS.get(combine)
+        if self.combine is None:
+            raise ElsterInvalidName(f"Invalid combine function: {combine}")
+
+    def value(self, parts):
+        """Combine the part values into a composite ElsterValue"""
+        first = parts[0]
+        value = self.combine([p.formatted_value for p in parts])
+        return ElsterValue(first.sender, first.receiver, first.register, value,
+                           timestamp=max(p.timestamp for p in parts))
+
+
+def config_entries(config):
+    """Return all configured data and composite entries"""
+    return config["data"] + config.get("composites", [])
+
+
+def response_time(fut):
+    """Return the response time of a completed read request, if it was measured"""
+    sent = getattr(fut, "sent", None)
+    received = getattr(fut, "received", None)
+    if sent is None or received is None:
+        return None
+    return received - sent
+
+
+class ElsterDispatcher(can.Listener):
+    """Elster response dispatcher class
+
+    Decodes every received frame once and routes responses to the future of
+    the matching outstanding read. Responses nobody is waiting for are handed
+    to the subscribers. Responses overheard on their way to other bus masters
+    are kept in a cache keyed by (receiver, register), responses to our own
+    reads are not.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.cache = {}
+        self.subscribers = []
+        self.frames = 0
+
+    def expect(self, receiver, register):
+        """Return the future for the response from receiver/register and whether it is new"""
+        key = (receiver, register)
+        with self.lock:
+            fut = self.pending.get(key)
+            if fut is None or fut.done():
+                fut = Future()
+                self.pending[key] = fut
+                return fut, True
+            return fut, False
+
+    def forget(self, receiver, register, fut):
+        """Drop the given future if it is still outstanding"""
+        key = (receiver, register)
+        with self.lock:
+            if self.pending.get(key) is fut:
+                del self.pending[key]
+
+    def cached(self, receiver, register, max_age):
+        """Return the overheard response from receiver/register if it is at most max_age seconds old"""
+        msg = self.cache.get((receiver, register))
+        if msg is None or time.monotonic() - msg.timestamp > max_age:
+            return None
+        return msg
+
+    def subscribe(self, callback):
+        """Call callback(msg) for every response that doesn't match an outstanding read"""
+        self.subscribers.append(callback)
+
+    def on_message_received(self, msg):
+        self.frames += 1
+        now = time.monotonic()
+        msg = ElsterValue.from_frame(msg.arbitration_id, msg.data, now)
+        if msg is None or msg.type != TYPE_RESPONSE:
+            return
+
+        key = (msg.sender, msg.register)
+        fut = None
+        if msg.receiver == self.sender:
+            with self.lock:
+                fut = self.pending.pop(key, None)
+        else:
+            self.cache[key] = msg
+        if fut and fut.set_running_or_notify_cancel():
+            fut.received = now
+            fut.set_result(msg)
+            return
+
+        for callback in self.subscribers:
+            callback(msg)
+
+
+class ReceiverHealth:
+    """Receiver health class
+
+    A circuit breaker: after 'threshold' consecutive timeouts the receiver is
+    considered unavailable and reads fail immediately. Once 'reset' seconds
+    have passed, a single probe read is let through, which closes the breaker
+    again if it succeeds.
+
+    Also estimates the read timeout from the measured response times like
+    TCP's retransmission timeout (RFC 6298), clamped to [timeout_min,
+    timeout_max]. Until the first response time is measured, the timeout is
+    timeout_initial.
+    """
+    def __init__(self, threshold=3, reset=60, timeout_min=0.05, timeout_max=30, timeout_initial=1):
+        self.threshold = threshold
+        self.reset = reset
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = min(timeout_initial, timeout_max)
+
+    @property
+    def available(self):
+        return self.opened is None
+
+    def allow(self, now):
+        """Return True if a read may be sent to the receiver"""
+        if self.opened is None:
+            return True
+        if not self.probing and now - self.opened >= self.reset:
+            self.probing = True
+            return True
+        return False
+
+    def success(self, rtt=None):
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        if rtt is None:
+            return
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.timeout_min), self.timeout_max)
+
+    def failure(self, now):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.opened = now
+        # Back off
+        self.timeout = min(self.timeout * 2, self.timeout_max)
 
 
 class ElsterBus:
-    """Elster bus class"""
-    def __init__(self, config, simulate=False):
+    """Elster bus class
+
+    If a recorder is given, all received frames that pass the CAN filters and
+    all sent requests are recorded.
+    """
+    def __init__(self, config, simulate=False, interface="socketcan", recorder=None):
         self.channel = config["can"]["interface"]
+        self.interface = interface
         self.sender = int(config["can"]["sender"], 16)
         self.config = {x["name"]: x for x in config["data"]}
         self.simulate = simulate
         self.bus = None
+        self.notifier = None
+        self.dispatcher = ElsterDispatcher(self.sender)
+        self.recorder = recorder
+        self.window = int(config["can"].get("window", 4))
+        self.max_ages = config_intervals(config, None, key="max_age")
+        self.formats = dict(FORMATS)
+        for name, spec in config.get("formats", {}).items():
+            if name in FORMATS:
+                raise ElsterInvalidFormat(f"Format {name} shadows a built-in format")
+            self.formats[name] = make_format(spec, self.formats)
+        self.registers = {}
+        for name, c in self.config.items():
+            rec, reg = c["index"].split(".")
+            self.registers[name] = ElsterRegister(self.sender, int(rec, 16), int(reg, 16), fmt=c.get("format"),
+                                                  max_age=self.max_ages.get(name), name=name, formats=self.formats)
+        self.composites = {c["name"]: ElsterComposite(self.sender, c, self.formats)
+                           for c in config.get("composites", [])}
+        self.names = list(self.registers) + list(self.composites)
+        self.index = {(r.receiver, r.register): name for name, r in self.registers.items()}
+        self.receivers = {receiver for receiver, _ in self.index}
+        self.receivers.update(p.receiver for c in self.composites.values() for p in c.parts)
+        self.breaker_threshold = int(config["can"].get("breaker_threshold", 3))
+        self.breaker_reset = float(config["can"].get("breaker_reset", 60))
+        self.probe_timeout = float(config["can"].get("probe_timeout", 2))
+        self.timeout_min = float(config["can"].get("timeout_min", 0.05))
+        self.timeout_max = float(config["can"].get("timeout_max", 30))
+        self.timeout_initial = float(config["can"].get("timeout_initial", 1))
+        self.health = {}
 
     def __enter__(self):
         if not self.simulate:
-            self.bus = can.Bus(channel=self.channel, interface="socketcan")
+            self.bus = can.Bus(channel=self.channel, interface=self.interface, can_filters=self.can_filters())
+            listeners = [self.dispatcher]
+            if self.recorder:
+                listeners.append(self.recorder)
+            self.notifier = can.Notifier(self.bus, listeners)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.notifier:
+            self.notifier.stop()
         if self.bus:
             self.bus.shutdown()
 
-    def config_lookup(self, name):
-        c = self.config.get(name)
-        if not c:
+    def lookup(self, name):
+        r = self.registers.get(name)
+        if not r:
             raise ElsterInvalidName(f"Invalid config name: {name}")
-        rec, reg = c["index"].split(".")
-        return int(rec, 16), int(reg, 16), c.get("format")
+        return r
+
+    def overheard(self, name, max_age):
+        """Return the response for the name overheard within the last max_age seconds, or None"""
+        r = self.registers.get(name)
+        if not r:
+            return None
+        return self.dispatcher.cached(r.receiver, r.register, max_age)
 
-    def read(self, name=None, receiver=None, register=None, fmt=None, timeout=30):
-        # Construct the read request
+    def can_filters(self):
+        """Return CAN filters that only pass frames sent by the known receivers"""
+        return [{"can_id": r, "can_mask": 0x7ff, "extended": False} for r in sorted(self.receivers)]
+
+    def receiver_health(self, receiver):
+        health = self.health.get(receiver)
+        if health is None:
+            health = self.health[receiver] = ReceiverHealth(self.breaker_threshold, self.breaker_reset,
+                                                            self.timeout_min, self.timeout_max,
+                                                            self.timeout_initial)
+        return health
+
+    def admit(self, receiver, timeout=None):
+        """Check that the receiver is available and return the timeout to use for a read"""
+        health = self.receiver_health(receiver)
+        if not health.allow(time.monotonic()):
+            raise ElsterReceiverUnavailable(f"Receiver {receiver:03x} is unavailable")
+        if timeout is None:
+            timeout = health.timeout
+        if health.probing:
+            return min(timeout, self.probe_timeout)
+        return timeout
+
+    def request(self, reg):
+        """Send the register's read request, unless the same read is already in flight, and return its future"""
+        receiver, register = reg.receiver, reg.register
+        if receiver not in self.receivers:
+            self.receivers.add(receiver)
+            self.bus.set_filters(self.can_filters())
+        fut, new = self.dispatcher.expect(receiver, register)
+        if new:
+            fut.sent = time.monotonic()
+            # Record before sending, so that the response can't be logged first
+            if self.recorder:
+                self.recorder.record(reg.request, timestamp=time.time())
+            self.bus.send(reg.request)
+        return fut
+
+    def read(self, name=None, receiver=None, register=None, fmt=None, timeout=None):
+        if name in self.composites:
+            return self.read_composite(name, timeout=timeout)
+
+        # Look up or construct the read request
         if name:
-            receiver, register, fmt = self.config_lookup(name)
-        msg = ElsterMessage(sender=self.sender, receiver=receiver, register=register, fmt=fmt)
+            reg = self.lookup(name)
+        else:
+            reg = ElsterRegister(self.sender, receiver, register, fmt=fmt, formats=self.formats)
+        receiver, register = reg.receiver, reg.register
 
         if self.simulate:
-            msg.value = 12345
-            return msg
+            return ElsterValue(receiver, self.sender, register, 12345, timestamp=time.monotonic()).with_register(reg)
 
-        # Send the read request
-        self.bus.send(msg)
+        # Send the read request and wait for the response
+        timeout = self.admit(receiver, timeout)
+        health = self.receiver_health(receiver)
+        fut = self.request(reg)
+        try:
+            msg = fut.result(timeout=timeout)
+        except FutureTimeoutError:
+            self.dispatcher.forget(receiver, register, fut)
+            health.failure(time.monotonic())
+            raise ElsterReadTimedOut("Timed out waiting for a response") from None
+        health.success(response_time(fut))
+        return msg.with_register(reg)
 
-        # Wait for the response
-        start_time = time.time()
-        while time.time() < (start_time + timeout):
-            m = self.bus.recv(timeout=timeout)
-            try:
-                msg = ElsterMessage(msg=m, fmt=fmt)
-                if msg.type == TYPE_RESPONSE and msg.sender == receiver and msg.receiver == self.sender:
-                    return msg
-            except ElsterError as e:
-                print(e)
-        raise ElsterReadTimedOut("Timed out waiting for a response")
+    def read_composite(self, name, timeout=None):
+        """Read all parts of a composite back to back and return the combined value"""
+        composite = self.composites[name]
+        parts = dict(self.iter_requests([list(enumerate(composite.parts))], timeout=timeout))
+        for result in parts.values():
+            if isinstance(result, ElsterError):
+                raise result
+        return composite.value([parts[i] for i in range(len(composite.parts))])
+
+    def read_many(self, names, window=None, timeout=None):
+        """Read the given names with up to 'window' requests in flight
+
+        Names that time out or whose receiver is unavailable are reported and
+        left out of the returned results.
+        """
+        return dict(self.iter_read(names, window=window, timeout=timeout))
+
+    def iter_read(self, names, window=None, timeout=None):
+        """Like read_many() but yield (name, msg) as soon as each response arrives
+
+        The parts of composites are requested back to back and the combined
+        value is yielded once all of them have arrived.
+        """
+        requests = []
+        parts = {}
+        for name in names:
+            if name in self.composites:
+                parts[name] = {}
+                requests.append([((name, i), p) for i, p in enumerate(self.composites[name].parts)])
+            else:
+                requests.append((name, self.lookup(name)))
+
+        for key, result in self.iter_requests(requests, window=window, timeout=timeout):
+            if isinstance(key, tuple):
+                name, i = key
+                if name not in parts:
+                    continue
+                if isinstance(result, ElsterError):
+                    print(f"{name}: {result}")
+                    del parts[name]
+                    continue
+                composite = self.composites[name]
+                parts[name][i] = result
+                if len(parts[name]) == len(composite.parts):
+                    results = parts.pop(name)
+                    yield name, composite.value([results[i] for i in range(len(composite.parts))])
+                continue
+
+            if isinstance(result, ElsterError):
+                print(f"{key}: {result}")
+                continue
+            yield key, result
+
+    def iter_requests(self, requests, window=None, timeout=None, breaker=True):
+        """Send the given read requests with up to 'window' in flight
+
+        Each request is a tuple (key, ElsterRegister), or a list of them that
+        is sent in one go even if that exceeds the window, like the parts of a
+        composite. Yields (key, msg) as soon as each response arrives or is
+        found in the cache, and (key, error) for requests that time out or
+        whose receiver is unavailable. With breaker disabled, timeouts don't
+        count against the receiver's health.
+        """
+        if window is None:
+            window = self.window
+
+        groups = (req if isinstance(req, list) else [req] for req in requests)
+        if self.simulate:
+            for key, reg in itertools.chain.from_iterable(groups):
+                yield key, ElsterValue(reg.receiver, self.sender, reg.register, 12345,
+                                       timestamp=time.monotonic()).with_register(reg)
+            return
+
+        # Outstanding requests, keyed by their futures. Requests for the same
+        # register share a future, so each one has a list of (key, reg).
+        pending = {}
+        while True:
+            # Fill the window
+            while len(pending) < window:
+                group = next(groups, None)
+                if group is None:
+                    break
+                for key, reg in group:
+                    if reg.max_age is not None:
+                        msg = self.dispatcher.cached(reg.receiver, reg.register, reg.max_age)
+                        if msg:
+                            yield key, msg.with_register(reg)
+                            continue
+                    try:
+                        t = self.admit(reg.receiver, timeout)
+                    except ElsterReceiverUnavailable as e:
+                        yield key, e
+                        continue
+                    fut = self.request(reg)
+                    if fut in pending:
+                        pending[fut][3].append((key, reg))
+                    else:
+                        pending[fut] = (reg.receiver, reg.register, time.monotonic() + t, [(key, reg)])
+
+            if not pending:
+                return
+
+            # Wait for the next response
+            remaining = min(p[2] for p in pending.values()) - time.monotonic()
+            done, _ = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            for fut in done:
+                receiver, _, _, waiters = pending.pop(fut)
+                self.receiver_health(receiver).success(response_time(fut))
+                for key, reg in waiters:
+                    yield key, fut.result().with_register(reg)
+
+            now = time.monotonic()
+            for fut in [fut for fut, p in pending.items() if p[2] <= now]:
+                receiver, register, _, waiters = pending.pop(fut)
+                self.dispatcher.forget(receiver, register, fut)
+                if breaker:
+                    self.receiver_health(receiver).failure(now)
+                for key, _ in waiters:
+                    yield key, ElsterReadTimedOut("Timed out waiting for a response")
 
 
 class MqttClient:
@@ -183,20 +756,393 @@ class MqttClient:
             self.client.publish(topic, value)
 
 
+class ElsterScheduler:
+    """Heap based polling scheduler
+
+    Names that fall due within the same tick are returned together so that
+    they can be read in one batch.
+    """
+    def __init__(self, intervals, tick=1.0, now=0.0):
+        self.intervals = intervals
+        self.tick = tick
+        self.heap = [(now, name) for name in intervals]
+        heapq.heapify(self.heap)
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, now):
+        """Return the names that are due at 'now' and reschedule them"""
+        batch = []
+        while self.heap and self.heap[0][0] <= now + self.tick:
+            batch.append(heapq.heappop(self.heap))
+        for due, name in batch:
+            # Don't try to catch up on missed slots
+            due += self.intervals[name]
+            if due <= now:
+                due = now + self.intervals[name]
+            heapq.heappush(self.heap, (due, name))
+        return [name for _, name in batch]
+
+
+def config_intervals(config, default, key="interval", derived=False):
+    """Return the 'key' interval in seconds for each configured (and optionally derived) name"""
+    classes = {k: float(v) for k, v in config.get("intervals", {}).items()}
+    intervals = {}
+    for c in config_entries(config) + (config.get("derived", []) if derived else []):
+        interval = c.get(key, default)
+        if interval is None:
+            continue
+        intervals[c["name"]] = classes[interval] if interval in classes else float(interval)
+    return intervals
+
+
+class ChangeFilter:
+    """Publish filter class
+
+    Passes a value only if it moved past the name's deadband (absolute, or
+    relative if given in percent) since it was last published, or if the
+    name's max_interval heartbeat expired. Names without a deadband or
+    max_interval always pass. The last published values can be persisted in
+    a state file.
+    """
+    def __init__(self, config, state_file=None):
+        self.deadbands = {}
+        for c in config_entries(config) + config.get("derived", []):
+            deadband = c.get("deadband")
+            if deadband is None:
+                continue
+            if deadband.endswith("%"):
+                self.deadbands[c["name"]] = (float(deadband[:-1]) / 100, True)
+            else:
+                self.deadbands[c["name"]] = (float(deadband), False)
+        self.max_intervals = config_intervals(config, None, key="max_interval", derived=True)
+        self.state_file = state_file
+        self.last = {}
+        if state_file and os.path.exists(state_file):
+            with open(state_file, "r") as fh:
+                self.last = json.load(fh)
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmp = f"{self.state_file}.tmp"
+        try:
+            with open(tmp, "w") as fh:
+                json.dump(self.last, fh)
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            print(f"Failed to save state: {e}")
+
+    def changed(self, name, value, now=None):
+        """Return True if the value should be published and remember it if so"""
+        if name not in self.deadbands and name not in self.max_intervals:
+            return True
+        if now is None:
+            now = time.time()
+
+        last = self.last.get(name)
+        if last is None or self._moved(name, last[0], value):
+            pass
+        elif name in self.max_intervals and now - last[1] >= self.max_intervals[name]:
+            pass
+        else:
+            return False
+        self.last[name] = [value, now]
+        return True
+
+    def _moved(self, name, old, new):
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            return old != new
+        deadband, relative = self.deadbands.get(name, (0, False))
+        if relative:
+            deadband = abs(old) * deadband
+        return abs(new - old) > deadband
+
+
+def sd_notify(state):
+    """Send a state notification to systemd, if running as a notify service"""
+    addr = os.environ.get("NOTIFY_SOCKET")
+    if not addr:
+        return
+    if addr[0] == "@":
+        addr = "\0" + addr[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+        sock.connect(addr)
+        sock.sendall(state.encode())
+
+
+class DerivedValues:
+    """Derived values class
+
+    Evaluates the expressions declared under 'derived:' in the config. An
+    expression can use configured names (including other derived values),
+    numbers, arithmetic operators and the functions abs, min, max and round.
+    The expressions are compiled into a dependency graph so that only the
+    ones affected by a changed input are re-evaluated. Inputs must be one of
+    the given names (by default the configured data and composite names) or
+    another derived value.
+    """
+    FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+    NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.Constant, ast.Call,
+             ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd)
+
+    def __init__(self, config, names=None):
+        if names is None:
+            names = [c["name"] for c in config_entries(config)]
+        derived = config.get("derived", [])
+        known = set(names) | {c["name"] for c in derived}
+        self.exprs = {}
+        self.inputs = {}
+        self.digits = {}
+        for c in derived:
+            name = c["name"]
+            tree = ast.parse(c["expr"], mode="eval")
+            inputs = set()
+            for node in ast.walk(tree):
+                if not isinstance(node, self.NODES):
+                    raise ElsterInvalidExpression(f"{name}: Unsupported expression: {ast.dump(node)}")
+                if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and
+                                                       node.func.id in self.FUNCTIONS):
+                    raise ElsterInvalidExpression(f"{name}: Unsupported function call")
+                if isinstance(node, ast.Name) and node.id not in self.FUNCTIONS:
+                    inputs.add(node.id)
+            unknown = inputs - known
+            if unknown:
+                raise ElsterInvalidExpression(f"{name}: Unknown input: {', '.join(sorted(unknown))}")
+            self.exprs[name] = compile(tree, f"<derived {name}>", "eval")
+            self.inputs[name] = inputs
+            if "digits" in c:
+                self.digits[name] = int(c["digits"])
+
+        # Map each input to the derived values that depend on it, in evaluation order
+        order = self._order()
+        self.dependents = {}
+        for name in order:
+            for i in self.inputs[name]:
+                self.dependents.setdefault(i, []).append(name)
+        self.rank = {name: i for i, name in enumerate(order)}
+        self.values = {}
+
+    def _order(self):
+        """Return the derived names in topological order"""
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ElsterInvalidExpression(f"{name}: Circular dependency")
+            state[name] = "visiting"
+            for i in self.inputs[name]:
+                if i in self.exprs:
+                    visit(i)
+            state[name] = "done"
+            order.append(name)
+
+        for name in self.exprs:
+            visit(name)
+        return order
+
+    def update(self, name, value):
+        """Set an input value and return the list of (name, value) of the derived values that changed"""
+        if name in self.values and self.values[name] == value:
+            return []
+        self.values[name] = value
+
+        results = []
+        todo = set(self.dependents.get(name, []))
+        while todo:
+            derived = min(todo, key=self.rank.get)
+            todo.remove(derived)
+            if not self.inputs[derived].issubset(self.values):
+                continue
+            env = {i: self.values[i] for i in self.inputs[derived]}
+            try:
+                result = eval(self.exprs[derived], {"__builtins__": {}, **self.FUNCTIONS}, env)
+            except (ArithmeticError, TypeError) as e:
+                print(f"{derived}: {e}")
+                continue
+            if derived in self.digits:
+                result = round(result, self.digits[derived])
+            if derived in self.values and self.values[derived] == result:
+                continue
+            self.values[derived] = result
+            results.append((derived, result))
+            todo.update(self.dependents.get(derived, []))
+        return results
+
+
+class Publisher:
+    """Publisher class
+
+    Publishes values to MQTT. With mqtt.stream enabled, each value is
+    published to its own topic as soon as it is available. The aggregate
+    'info' snapshot is published on flush() unless mqtt.snapshot is disabled.
+    If a ChangeFilter is given, only values that pass it are streamed and the
+    snapshot is only published if any did. Derived values are published
+    alongside the values they depend on.
+    """
+    def __init__(self, mqttc, config, changes=None, derived=None):
+        self.mqttc = mqttc
+        self.derived = derived
+        self.stream = config["mqtt"].get("stream", "false") == "true"
+        self.snapshot = config["mqtt"].get("snapshot", "true") == "true"
+        self.changes = changes
+        self.info = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def publish(self, name, value, stream=None):
+        if stream is None:
+            stream = self.stream
+        self._publish(name, value, stream)
+        if self.derived:
+            with self.lock:
+                updates = self.derived.update(name, value)
+            for derived, derived_value in updates:
+                self._publish(derived, derived_value, stream)
+
+    def _publish(self, name, value, stream):
+        with self.lock:
+            self.info[name.lower()] = value
+            if self.changes and not self.changes.changed(name, value):
+                return
+            self.changed = True
+        if stream:
+            self.mqttc.publish(name.lower(), value)
+
+    def flush(self):
+        with self.lock:
+            if not (self.snapshot and self.changed):
+                return
+            self.changed = False
+            info = json.dumps(self.info)
+        self.mqttc.publish("info", info)
+
+
+def poll(elster, publisher, names=None):
+    """Read the given (or all configured) names and publish them"""
+    if names is None:
+        names = elster.names
+    for name, msg in elster.iter_read(names):
+        print(f"{name} ({msg.sender:03x}.{msg.register:04x}): {msg.formatted_value}")
+        publisher.publish(name, msg.formatted_value)
+    publisher.flush()
+
+
+def start_sniffing(elster, publisher):
+    """Publish overheard responses for configured names"""
+    def on_response(msg):
+        name = elster.index.get((msg.sender, msg.register))
+        if name is None:
+            return
+        msg = msg.with_register(elster.registers[name])
+        print(f"{name} ({msg.sender:03x}.{msg.register:04x}) -> {msg.receiver:03x}: {msg.formatted_value}")
+        publisher.publish(name, msg.formatted_value, stream=True)
+
+    elster.dispatcher.subscribe(on_response)
+
+
+def run_daemon(elster, publisher, intervals, sniff=False, stop=None):
+    """Poll each name at its interval until the stop event is set
+
+    In sniff mode, responses to other bus masters for configured names are
+    published as they are overheard, and only names that haven't been
+    overheard within their interval are actively read.
+    """
+    if stop is None:
+        stop = threading.Event()
+
+    if sniff:
+        start_sniffing(elster, publisher)
+
+    scheduler = ElsterScheduler(intervals, now=time.monotonic())
+
+    sd_notify("READY=1")
+    while not stop.is_set():
+        start = time.monotonic()
+        names = scheduler.due(start)
+        if sniff:
+            # Overheard values have already been published
+            names = [n for n in names if not elster.overheard(n, intervals[n])]
+        try:
+            poll(elster, publisher, names=names)
+            sd_notify(f"STATUS=Last poll of {len(names)} names took {time.monotonic() - start:.1f}s")
+        except ElsterError as e:
+            print(e)
+            sd_notify(f"STATUS=Last poll failed: {e}")
+        next_due = scheduler.next_due()
+        stop.wait(None if next_due is None else max(0, next_due - time.monotonic()))
+    sd_notify("STOPPING=1")
+
+
 def main():
     """Main entry point"""
     parser = argparse.ArgumentParser()
     parser.add_argument("config", help="Configuration file in YAML format")
     parser.add_argument("--simulate-can", action="store_true", default=False, help="Simulate CAN bus read")
+    parser.add_argument("--simulate-bus", action="store_true", default=False,
+                        help="Read from a simulated heat pump on a virtual CAN bus")
     parser.add_argument("--simulate-mqtt", action="store_true", default=False, help="Simulate MQTT publish")
     parser.add_argument("--name", help="Read the given name")
     parser.add_argument("--index", help="Read the given index")
+    parser.add_argument("--scan", action="append", metavar="RANGE",
+                        help="Scan the given register range RRR[.SSSS[-EEEE]] (can be repeated)")
+    parser.add_argument("--scan-output", help="Write scan hits to the given file instead of stdout")
+    parser.add_argument("--scan-checkpoint", help="Resume the scan from and save its progress to the given file")
+    parser.add_argument("--asyncio", action="store_true", default=False, help="Use the asyncio bus and MQTT client")
+    parser.add_argument("--daemon", action="store_true", default=False, help="Keep running and poll periodically")
+    parser.add_argument("--interval", type=int, help="Polling interval in seconds in daemon mode")
+    parser.add_argument("--record", metavar="FILE", help="Record all CAN frames to the given binary log file")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="Publish the responses in the given frame log instead of reading the CAN bus")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Replay speed factor, 0 replays as fast as possible (default: 1)")
+    parser.add_argument("--sniff", action="store_true", default=False,
+                        help="Like --daemon but also publish responses to other bus masters and only "
+                        "read names nobody else polls")
     args = parser.parse_args()
 
+    if args.asyncio:
+        unsupported = [flag for flag, value in (("--daemon", args.daemon), ("--sniff", args.sniff),
+                                                ("--scan", args.scan), ("--replay", args.replay)) if value]
+        if unsupported:
+            parser.error(f"--asyncio can't be combined with {', '.join(unsupported)}")
+
     with open(args.config, "r") as fh:
         config = yaml.load(fh, Loader=yaml.BaseLoader)
 
-    with ElsterBus(config, simulate=args.simulate_can) as elster, MqttClient(config, simulate=args.simulate_mqtt) as mqttc:
+    if args.replay:
+        from .replay import run_replay
+        with MqttClient(config, simulate=args.simulate_mqtt) as mqttc:
+            elster = ElsterBus(config, simulate=True)
+            publisher = Publisher(mqttc, config, derived=DerivedValues(config, elster.names))
+            run_replay(elster, publisher, args.replay, speed=args.replay_speed)
+        return
+
+    with contextlib.ExitStack() as stack:
+        if args.simulate_bus:
+            from .simulator import ElsterSimulator
+            stack.enter_context(ElsterSimulator(config, interface="virtual"))
+            interface = "virtual"
+        else:
+            interface = "socketcan"
+        recorder = None
+        if args.record:
+            from .recorder import FrameRecorder
+            recorder = stack.enter_context(FrameRecorder(args.record))
+
+        if args.asyncio:
+            from .aio import amain
+            asyncio.run(amain(config, args, interface=interface, recorder=recorder))
+            return
+
+        elster = stack.enter_context(ElsterBus(config, simulate=args.simulate_can, interface=interface,
+                                               recorder=recorder))
+        mqttc = stack.enter_context(MqttClient(config, simulate=args.simulate_mqtt))
+
         if args.name:
             msg = elster.read(args.name)
             print(f"{args.name} ({msg.sender:03x}.{msg.register:04x}): {msg.formatted_value}")
@@ -208,12 +1154,31 @@ def main():
             print(f"UNBEKANNT ({args.index}): {msg.value}")
             return
 
-        info = {}
-        for name in elster.config:
-            msg = elster.read(name)
-            print(f"{name} ({msg.sender:03x}.{msg.register:04x}): {msg.formatted_value}")
-            info[name.lower()] = msg.formatted_value
-        mqttc.publish("info", json.dumps(info))
+        if args.scan:
+            from .scan import ElsterScanner, parse_scan_range
+            ranges = [parse_scan_range(spec) for spec in args.scan]
+            if args.scan_output:
+                with open(args.scan_output, "a") as out:
+                    hits = ElsterScanner(elster, ranges, out, checkpoint=args.scan_checkpoint).run()
+            else:
+                hits = ElsterScanner(elster, ranges, sys.stdout, checkpoint=args.scan_checkpoint).run()
+            print(f"Found {hits} registers", file=sys.stderr)
+            return
+
+        changes = ChangeFilter(config, state_file=config["mqtt"].get("state_file"))
+        publisher = Publisher(mqttc, config, changes=changes, derived=DerivedValues(config, elster.names))
+
+        if args.daemon or args.sniff:
+            interval = args.interval or int(config.get("daemon", {}).get("interval", 300))
+            stop = threading.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, lambda signum, frame: stop.set())
+            run_daemon(elster, publisher, config_intervals(config, interval), sniff=args.sniff, stop=stop)
+            changes.save()
+            return
+
+        poll(elster, publisher)
+        changes.save()
 
 
 if __name__ == "__main__":
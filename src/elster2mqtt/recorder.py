@@ -0,0 +1,118 @@
+#
+# Binary CAN frame recorder and log reader
+#
+
+import mmap
+import struct
+import threading
+
+import can
+
+# Fixed-size frame record: timestamp, arbitration ID, DLC, padding, payload
+RECORD = struct.Struct("<dIB3x8s")
+
+
+class FrameRecorder(can.Listener):
+    """Frame recorder class
+
+    Appends every frame it is given to a binary log file of fixed-size
+    records. Received frames are fed to it by the bus notifier, sent frames
+    by ElsterBus.request().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fh = open(path, "ab")
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def record(self, msg, timestamp=None):
+        data = bytes(msg.data)
+        rec = RECORD.pack(msg.timestamp if timestamp is None else timestamp, msg.arbitration_id, len(data), data)
+        with self.lock:
+            self.fh.write(rec)
+            self.frames += 1
+
+    def on_message_received(self, msg):
+        self.record(msg)
+
+    def flush(self):
+        with self.lock:
+            self.fh.flush()
+
+    def stop(self):
+        with self.lock:
+            if not self.fh.closed:
+                self.fh.close()
+
+
+class FrameLog:
+    """Frame log class
+
+    Memory-maps a log written by FrameRecorder. Records are accessed by
+    index in O(1) and located by time with a binary search, so that large
+    logs don't need to be parsed as a whole. A trailing partial record of a
+    log that is still being written is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            size = fh.seek(0, 2)
+            self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = size // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, i):
+        """Return the raw (timestamp, arbitration_id, dlc, data) tuple of record 'i'"""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("Frame log index out of range")
+        return RECORD.unpack_from(self.mmap, i * RECORD.size)
+
+    def timestamp(self, i):
+        return struct.unpack_from("<d", self.mmap, i * RECORD.size)[0]
+
+    def __getitem__(self, i):
+        timestamp, arbitration_id, dlc, data = self.record(i)
+        return can.Message(timestamp=timestamp, arbitration_id=arbitration_id, data=data[:dlc],
+                           is_extended_id=False)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def bisect(self, timestamp):
+        """Return the index of the first record at or after 'timestamp'"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def between(self, start=None, end=None):
+        """Yield the frames with start <= timestamp < end"""
+        first = 0 if start is None else self.bisect(start)
+        last = self.count if end is None else self.bisect(end)
+        for i in range(first, last):
+            yield self[i]
@@ -0,0 +1,58 @@
+#
+# Replay recorded CAN traffic through the decode, format and publish pipeline
+#
+
+import os
+import sys
+import time
+
+import can
+
+from .elster2mqtt import start_sniffing
+from .recorder import FrameLog
+
+# Log formats read by python-can, anything else is read as a FrameRecorder log
+LOG_FORMATS = (".asc", ".blf", ".csv", ".log", ".mf4", ".trc")
+
+
+def open_log(path):
+    """Return an iterable of the frames in the given log file"""
+    base, ext = os.path.splitext(path)
+    if ext.lower() == ".gz":
+        ext = os.path.splitext(base)[1]
+    if ext.lower() in LOG_FORMATS:
+        return can.LogReader(path)
+    return FrameLog(path)
+
+
+def replay(frames, listener, speed=1.0, sleep=time.sleep):
+    """Feed the frames to the listener and return the number of frames
+
+    The original timing is scaled by 'speed', i.e. 2 replays twice as fast
+    as recorded and 0 replays as fast as possible.
+    """
+    count = 0
+    first = start = None
+    for msg in frames:
+        if speed > 0:
+            if first is None:
+                first, start = msg.timestamp, time.monotonic()
+            delay = (msg.timestamp - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+        listener.on_message_received(msg)
+        count += 1
+    return count
+
+
+def run_replay(elster, publisher, path, speed=1.0):
+    """Publish the configured names from the responses in the given log file"""
+    start_sniffing(elster, publisher)
+    start = time.monotonic()
+    with open_log(path) as frames:
+        count = replay(frames, elster.dispatcher, speed=speed)
+    publisher.flush()
+    elapsed = time.monotonic() - start
+    print(f"Replayed {count} frames in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} frames/s)",
+          file=sys.stderr)
+    return count
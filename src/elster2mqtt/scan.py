@@ -0,0 +1,81 @@
+#
+# Scan Elster register ranges
+#
+
+import json
+import os
+import time
+
+from .elster2mqtt import NO_VALUE, ElsterError, ElsterRegister
+
+
+def parse_scan_range(spec):
+    """Parse a scan range 'RRR[.SSSS[-EEEE]]' into (receiver, first, last)"""
+    rec, _, regs = spec.partition(".")
+    if not regs:
+        return int(rec, 16), 0x0000, 0xffff
+    first, _, last = regs.partition("-")
+    return int(rec, 16), int(first, 16), int(last or first, 16)
+
+
+class ElsterScanner:
+    """Elster register scanner class
+
+    Sweeps register ranges of one or more receivers with pipelined reads and
+    writes every register that returns a value to 'out' as soon as it
+    arrives. Progress is tracked per range as the first register that hasn't
+    been completed yet and is saved to the checkpoint file, keyed by the
+    range in 'RRR.SSSS-EEEE' form, so that an interrupted scan can be resumed.
+    """
+    def __init__(self, elster, ranges, out, checkpoint=None):
+        self.elster = elster
+        self.ranges = ranges
+        self.out = out
+        self.checkpoint = checkpoint
+        self.resume = {}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, "r") as fh:
+                self.resume = json.load(fh)
+        self.progress = {}
+
+    @staticmethod
+    def _key(receiver, first, last):
+        return f"{receiver:03x}.{first:04x}-{last:04x}"
+
+    def save(self):
+        if not self.checkpoint:
+            return
+        tmp = f"{self.checkpoint}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump({self._key(*self.ranges[i]): v for i, v in self.progress.items()}, fh)
+        os.replace(tmp, self.checkpoint)
+
+    def requests(self):
+        for i, (receiver, first, last) in enumerate(self.ranges):
+            start = max(first, self.resume.get(self._key(receiver, first, last), first))
+            self.progress[i] = start
+            for register in range(start, last + 1):
+                yield (i, register), ElsterRegister(self.elster.sender, receiver, register)
+
+    def run(self, save_interval=5):
+        """Scan all ranges and return the number of hits"""
+        hits = 0
+        completed = {}
+        saved = time.monotonic()
+        for (i, register), result in self.elster.iter_requests(self.requests(), breaker=False):
+            if not isinstance(result, ElsterError) and result.value != NO_VALUE:
+                hits += 1
+                print(f"{self.ranges[i][0]:03x}.{register:04x}: {result.value}", file=self.out, flush=True)
+
+            # Advance the range's progress past all contiguously completed registers
+            done = completed.setdefault(i, set())
+            done.add(register)
+            while self.progress[i] in done:
+                done.remove(self.progress[i])
+                self.progress[i] += 1
+
+            if time.monotonic() - saved >= save_interval:
+                self.save()
+                saved = time.monotonic()
+        self.save()
+        return hits
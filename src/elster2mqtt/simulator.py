@@ -0,0 +1,204 @@
+#
+# Simulated Elster heat pump on a virtual or vcan CAN bus
+#
+
+import argparse
+import heapq
+import math
+import random
+import threading
+import time
+
+import can
+import yaml
+
+from .elster2mqtt import NO_VALUE, TYPE_REQUEST, config_entries, decode_elster_frame, encode_elster_frame
+
+
+class Waveform:
+    """Waveform class
+
+    Produces the raw 16-bit register value at a given time. Supported types:
+
+      constant:     value
+      sine:         value (mean), amplitude, period
+      ramp:         value (start), step (per second), min, max (wraps around)
+      random_walk:  value (start), step (max per read), min, max
+    """
+    def __init__(self, spec, rng=random):
+        self.rng = rng
+        self.type = spec.get("waveform", "constant")
+        if self.type not in ("constant", "sine", "ramp", "random_walk"):
+            raise ValueError(f"Invalid waveform: {self.type}")
+        self.value = float(spec.get("value", 0))
+        self.amplitude = float(spec.get("amplitude", 0))
+        self.period = float(spec.get("period", 3600))
+        self.step = float(spec.get("step", 1))
+        self.min = float(spec.get("min", 0))
+        self.max = float(spec.get("max", 0xffff))
+        self.current = self.value
+
+    def __call__(self, t):
+        if self.type == "sine":
+            value = self.value + self.amplitude * math.sin(2 * math.pi * t / self.period)
+        elif self.type == "ramp":
+            value = self.min + (self.value - self.min + self.step * t) % (self.max - self.min + 1)
+        elif self.type == "random_walk":
+            self.current = min(max(self.current + self.rng.uniform(-self.step, self.step), self.min), self.max)
+            value = self.current
+        else:
+            value = self.value
+        return int(round(value)) & 0xffff
+
+
+class ElsterSimulator:
+    """Elster simulator class
+
+    Answers Elster read requests on a CAN bus from a register model, with a
+    configurable response latency, jitter and frame loss. It can also
+    generate unsolicited traffic of another bus master polling the
+    configured registers, like the heat pump manager or the room display do.
+
+    The model is configured in the 'simulator:' section of the config:
+
+      latency:   response latency in seconds
+      jitter:    max additional random latency in seconds
+      loss:      probability of a request not being answered
+      master:    sender ID of the other bus master
+      traffic:   requests per second sent by the other bus master
+      seed:      random seed
+      registers: per index waveform settings, see Waveform
+
+    All configured registers are simulated, by default with a constant
+    waveform of value 0. Unknown registers of simulated receivers are
+    answered with 0x8000.
+    """
+    def __init__(self, config, channel=None, interface="virtual"):
+        sim = config.get("simulator", {})
+        self.channel = channel or config["can"]["interface"]
+        self.interface = interface
+        self.latency = float(sim.get("latency", 0.02))
+        self.jitter = float(sim.get("jitter", 0))
+        self.loss = float(sim.get("loss", 0))
+        self.master = int(sim.get("master", "100"), 16)
+        self.traffic = float(sim.get("traffic", 0))
+        self.random = random.Random(sim.get("seed"))
+
+        self.registers = {}
+        for c in config_entries(config):
+            parts = c.get("parts", [c])
+            for part in parts:
+                index = part if isinstance(part, str) else part["index"]
+                self.registers[self._key(index)] = Waveform({}, self.random)
+        for index, spec in sim.get("registers", {}).items():
+            self.registers[self._key(index)] = Waveform(spec, self.random)
+        self.receivers = {receiver for receiver, _ in self.registers}
+
+        self.bus = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.start_time = None
+        self.queue = []
+        self.requests = 0
+        self.responses = 0
+
+    @staticmethod
+    def _key(index):
+        rec, reg = index.split(".")
+        return int(rec, 16), int(reg, 16)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.bus = can.Bus(channel=self.channel, interface=self.interface)
+        self.start_time = time.monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="ElsterSimulator", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.bus:
+            self.bus.shutdown()
+
+    def value(self, receiver, register):
+        waveform = self.registers.get((receiver, register))
+        if waveform is None:
+            return NO_VALUE
+        return waveform(time.monotonic() - self.start_time)
+
+    def respond(self, requester, receiver, register, now):
+        """Queue the response to a read request"""
+        if self.random.random() < self.loss:
+            return
+        due = now + self.latency + self.random.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (due, requester, receiver, register))
+
+    def run(self):
+        next_traffic = time.monotonic()
+        traffic = sorted(self.registers)
+        i = 0
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+
+            # Send the responses that are due
+            while self.queue and self.queue[0][0] <= now:
+                _, requester, receiver, register = heapq.heappop(self.queue)
+                data = encode_elster_frame(requester, register, self.value(receiver, register))
+                self.bus.send(can.Message(arbitration_id=receiver, data=data, is_extended_id=False))
+                self.responses += 1
+
+            # Let the other bus master poll the next register
+            if self.traffic and traffic and now >= next_traffic:
+                receiver, register = traffic[i % len(traffic)]
+                i += 1
+                self.bus.send(can.Message(arbitration_id=self.master, data=encode_elster_frame(receiver, register),
+                                          is_extended_id=False))
+                self.respond(self.master, receiver, register, now)
+                next_traffic = now + 1 / self.traffic
+
+            # Wait for the next request
+            timeouts = [0.1]
+            if self.queue:
+                timeouts.append(self.queue[0][0] - now)
+            if self.traffic:
+                timeouts.append(next_traffic - now)
+            msg = self.bus.recv(timeout=max(min(timeouts), 0))
+            if msg is None:
+                continue
+            decoded = decode_elster_frame(msg.data)
+            if decoded is None or decoded[0] != TYPE_REQUEST or decoded[1] not in self.receivers:
+                continue
+            self.requests += 1
+            self.respond(msg.arbitration_id, decoded[1], decoded[2], time.monotonic())
+
+
+def main():
+    """Simulator entry point"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", help="Configuration file in YAML format")
+    parser.add_argument("--interface", default="socketcan",
+                        help="python-can interface to attach to (default: socketcan, e.g. for vcan0)")
+    parser.add_argument("--channel", help="CAN channel (default: can.interface from the config)")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as fh:
+        config = yaml.load(fh, Loader=yaml.BaseLoader)
+
+    with ElsterSimulator(config, channel=args.channel, interface=args.interface) as sim:
+        print(f"Simulating receivers {', '.join(f'{r:03x}' for r in sorted(sim.receivers))} on {sim.channel}")
+        try:
+            sim.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import sys
+
+import can
+import pytest
+import yaml
+
+from src.elster2mqtt.aio import AsyncElsterBus
+from src.elster2mqtt.elster2mqtt import ElsterReadTimedOut, main
+from src.elster2mqtt.recorder import FrameLog
+
+from .test_read import CONFIG, REGISTERS, DummyCanBus
+
+
+def test_async_read_many(monkeypatch):
+    dummy = DummyCanBus(sender=0x123, registers=dict(REGISTERS))
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: dummy)
+
+    async def run():
+        async with AsyncElsterBus(CONFIG) as elster:
+            foo = await elster.read("FOO")
+            msgs = await elster.read_many(["BAR", "BAZ"], window=2)
+        return foo, msgs
+
+    foo, msgs = asyncio.run(run())
+    assert foo.value == 0xdead
+    assert msgs["BAR"].formatted_value == 21.5
+    assert msgs["BAZ"].sender == 0x301
+
+
+def test_async_read_timeout(monkeypatch):
+    dummy = DummyCanBus(sender=0x123, registers={})
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: dummy)
+
+    async def run():
+        async with AsyncElsterBus(CONFIG) as elster:
+            await elster.read("FOO", timeout=0.1)
+
+    with pytest.raises(ElsterReadTimedOut):
+        asyncio.run(run())
+
+
+def test_amain_simulate_bus_record(monkeypatch, tmp_path, capsys):
+    config = tmp_path / "elster2mqtt.yaml"
+    config.write_text(yaml.dump({
+        "mqtt": {"server": "localhost", "port": "1883", "topic_prefix": "test/"},
+        "can": {"interface": "test_amain", "sender": "680"},
+        "data": [{"name": "WW_SOLL", "index": "180.0003", "format": "dec_val"}],
+        "simulator": {"latency": "0", "registers": {"180.0003": {"value": "480"}}},
+    }))
+    record = tmp_path / "frames.bin"
+    monkeypatch.setattr(sys, "argv", ["elster2mqtt", str(config), "--asyncio", "--simulate-bus", "--simulate-mqtt",
+                                      "--record", str(record), "--name", "WW_SOLL"])
+    main()
+    assert "WW_SOLL (180.0003): 48.0" in capsys.readouterr().out
+    with FrameLog(record) as log:
+        assert [m.arbitration_id for m in log] == [0x680, 0x180]
+
+
+def test_amain_publisher(monkeypatch, tmp_path, capsys):
+    config = tmp_path / "elster2mqtt.yaml"
+    config.write_text(yaml.dump({
+        "mqtt": {"server": "localhost", "port": "1883", "topic_prefix": "test/", "stream": "true",
+                 "snapshot": "false"},
+        "can": {"interface": "dummy", "sender": "680"},
+        "data": [{"name": "FOO", "index": "180.0001", "format": "dec_val"}],
+        "derived": [{"name": "DOPPELT", "expr": "FOO * 2"}],
+    }))
+    monkeypatch.setattr(sys, "argv", ["elster2mqtt", str(config), "--asyncio", "--simulate-can", "--simulate-mqtt"])
+    main()
+    out = capsys.readouterr().out
+    assert "Publish: test/foo: 1234.5" in out
+    assert "Publish: test/doppelt: 2469.0" in out
+    assert "test/info" not in out
+
+
+@pytest.mark.parametrize("flag", [["--daemon"], ["--sniff"], ["--scan", "180"], ["--replay", "frames.bin"]])
+def test_amain_unsupported(monkeypatch, flag):
+    monkeypatch.setattr(sys, "argv", ["elster2mqtt", "config.yaml", "--asyncio", *flag])
+    with pytest.raises(SystemExit):
+        main()
@@ -0,0 +1,46 @@
+import json
+import time
+
+from src.elster2mqtt.benchmark import LoopbackBroker, compare, percentile, run_benchmark
+from src.elster2mqtt.elster2mqtt import MqttClient
+
+CONFIG = {
+    "mqtt": {"server": "localhost", "port": "1883", "topic_prefix": "test/", "stream": "true"},
+    "can": {"interface": "dummy", "sender": "680", "timeout_max": "1"},
+    "data": [{"name": f"REG_{r:04x}", "index": f"180.{r:04x}", "format": "dec_val"} for r in range(14)],
+    "simulator": {"latency": "0.002", "jitter": "0.001", "traffic": "50"},
+}
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(list(range(101)), 99) == 99
+
+
+def test_benchmark(tmp_path):
+    results = run_benchmark(CONFIG, cycles=2, channel="test_benchmark")
+    print(json.dumps(results, indent=2))
+    assert results["cycles"] == 2
+    assert results["published_values"] == 28
+    assert 0 < results["cycle_time"]["mean"] < 1
+    assert 0 < results["latency"]["p50"] <= results["latency"]["p99"]
+    # At least a request and a response per value
+    assert results["frames_per_value"] >= 2
+
+    # Results can be stored and compared
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps(results))
+    assert len(compare(json.loads(path.read_text()), results)) == 5
+
+
+def test_loopback_broker():
+    with LoopbackBroker() as broker:
+        config = {"mqtt": {"server": "127.0.0.1", "port": str(broker.port), "topic_prefix": "test/"}}
+        with MqttClient(config) as mqttc:
+            for i in range(10):
+                mqttc.publish("foo", i)
+            deadline = time.monotonic() + 5
+            while broker.publishes < 10 and time.monotonic() < deadline:
+                time.sleep(0.01)
+    assert broker.publishes == 10
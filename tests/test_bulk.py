@@ -0,0 +1,90 @@
+import can
+import pytest
+
+from src.elster2mqtt import bulk
+from src.elster2mqtt.elster2mqtt import (ElsterBus,
+                                         decode_elster_frame,
+                                         encode_elster_frame,
+                                         make_format)
+from src.elster2mqtt.recorder import RECORD, FrameLog, FrameRecorder
+
+CONFIG = {
+    "can": {"interface": "dummy", "sender": "680"},
+    "formats": {"betriebsart": {"enum": {"1": "Bereitschaft", "3": "Tagbetrieb"}}},
+    "data": [
+        {"name": "AUSSENTEMPERATUR", "index": "180.000c", "format": "signed_dec_val"},
+        {"name": "BETRIEBSART", "index": "180.0112", "format": "betriebsart"},
+        {"name": "FEHLER", "index": "500.0001"},
+    ],
+}
+
+
+@pytest.mark.skipif(bulk.np is not None, reason="NumPy is installed")
+def test_requires_numpy(tmp_path):
+    with pytest.raises(ImportError, match="NumPy"):
+        bulk.load_frames(tmp_path / "frames.bin")
+
+
+def record(path):
+    with FrameRecorder(path) as recorder:
+        t = 1000.0
+        for value in (0xffec, 0x0032):
+            for data in (encode_elster_frame(0x180, 0x000c), encode_elster_frame(0x680, 0x000c, value)):
+                recorder.record(can.Message(timestamp=t, arbitration_id=0x680 if len(data) == 5 else 0x180,
+                                            data=data, is_extended_id=False))
+                t += 1
+        for data in (encode_elster_frame(0x680, 0x0112, 3), bytes([0x92, 0x00, 0x01, 0x00, 0x05]),
+                     bytes([0x92, 0x00, 0x0d, 0x00, 0xd7, 0x00, 0x00]),
+                     bytes([0x61, 0x00, 0x05]), bytes([0x01, 0x02])):
+            recorder.record(can.Message(timestamp=t, arbitration_id=0x180 if data[0] & 2 else 0x500,
+                                        data=data, is_extended_id=False))
+            t += 1
+
+
+def test_decode_frames(tmp_path):
+    np = pytest.importorskip("numpy")
+    path = tmp_path / "frames.bin"
+    record(path)
+    frames = bulk.load_frames(path)
+    assert bulk.FRAME_DTYPE.itemsize == RECORD.size
+    columns = bulk.decode_frames(frames)
+
+    # Same results as decoding frame by frame
+    with FrameLog(path) as log:
+        for i, msg in enumerate(log):
+            decoded = decode_elster_frame(msg.data)
+            assert columns["valid"][i] == (decoded is not None)
+            if decoded is None:
+                continue
+            msg_type, receiver, register, value = decoded
+            assert columns["sender"][i] == msg.arbitration_id
+            assert columns["type"][i] == msg_type
+            assert columns["receiver"][i] == receiver
+            assert columns["register"][i] == register
+            assert columns["has_value"][i] == (value is not None)
+            if value is not None:
+                assert columns["value"][i] == value
+    assert np.count_nonzero(columns["valid"]) == 8
+
+
+def test_bulk_values(tmp_path):
+    pytest.importorskip("numpy")
+    path = tmp_path / "frames.bin"
+    record(path)
+    values = bulk.bulk_values(bulk.decode_frames(bulk.load_frames(path)), ElsterBus(CONFIG, simulate=True))
+
+    timestamps, temperatures = values["AUSSENTEMPERATUR"]
+    assert list(timestamps) == [1001.0, 1003.0]
+    assert temperatures == pytest.approx([-2.0, 5.0])
+    assert list(values["BETRIEBSART"][1]) == ["Tagbetrieb"]
+    assert len(values["FEHLER"][0]) == 0
+
+
+def test_format_column():
+    np = pytest.importorskip("numpy")
+    raw = np.array([0x0001, 0x8001, 0x0100], dtype=np.int32)
+    assert list(bulk.format_column(raw, None)) == [1, 0x8001, 0x100]
+    assert list(bulk.format_column(raw, "signed")) == [1, -32767, 256]
+    assert list(bulk.format_column(raw, "little_endian")) == [0x0100, 0x0180, 0x0001]
+    bits = make_format({"bits": {"0": "A", "8": "B"}})
+    assert list(bulk.convert_column(raw, bits)) == [["A"], ["A"], ["B"]]
@@ -0,0 +1,88 @@
+import signal
+import socket
+import threading
+
+import can
+
+from src.elster2mqtt.elster2mqtt import (ElsterBus,
+                                         ElsterScheduler,
+                                         Publisher,
+                                         config_intervals,
+                                         poll,
+                                         run_daemon,
+                                         sd_notify,
+                                         start_sniffing)
+
+from .test_publish import DummyMqttClient
+from .test_read import CONFIG, REGISTERS, DummyCanBus
+
+
+def test_sd_notify(monkeypatch, tmp_path):
+    addr = str(tmp_path / "notify")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(addr)
+        monkeypatch.setenv("NOTIFY_SOCKET", addr)
+        sd_notify("READY=1")
+        assert sock.recv(64) == b"READY=1"
+
+
+def test_sd_notify_no_socket(monkeypatch):
+    monkeypatch.delenv("NOTIFY_SOCKET", raising=False)
+    sd_notify("READY=1")
+
+
+def test_scheduler():
+    scheduler = ElsterScheduler({"FAST": 10, "SLOW": 60, "FASTER": 5}, tick=1.0)
+    assert sorted(scheduler.due(0)) == ["FAST", "FASTER", "SLOW"]
+    assert scheduler.next_due() == 5
+    assert scheduler.due(4.5) == ["FASTER"]
+    assert sorted(scheduler.due(10)) == ["FAST", "FASTER"]
+    assert scheduler.due(12) == []
+    # Missed slots are not caught up
+    assert sorted(scheduler.due(100)) == ["FAST", "FASTER", "SLOW"]
+    assert scheduler.next_due() == 105
+    assert scheduler.due(100.2) == []
+
+
+def test_config_intervals():
+    config = {
+        "intervals": {"fast": "60"},
+        "data": [
+            {"name": "FOO", "index": "180.0001", "interval": "fast"},
+            {"name": "BAR", "index": "180.0002", "interval": "15"},
+            {"name": "BAZ", "index": "180.0003"},
+        ],
+    }
+    assert config_intervals(config, 300) == {"FOO": 60, "BAR": 15, "BAZ": 300}
+
+
+def test_sniff_own_reads_not_overheard(monkeypatch):
+    bus = DummyCanBus(sender=0x123, registers=dict(REGISTERS))
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: bus)
+    config = dict(CONFIG, mqtt={"stream": "true", "snapshot": "false"})
+    mqttc = DummyMqttClient()
+    publisher = Publisher(mqttc, config)
+    with ElsterBus(config) as elster:
+        start_sniffing(elster, publisher)
+        for _ in range(2):
+            poll(elster, publisher, names=["FOO"])
+            # Our own reads don't count as overheard, so run_daemon() reads FOO again next interval
+            assert elster.overheard("FOO", 60) is None
+    assert bus.sent == [(0x180, 0xdeaf)] * 2
+    assert mqttc.published == [("foo", 0xdead)] * 2
+
+
+def test_run_daemon_keeps_signal_handlers():
+    handlers = [signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)]
+    stop = threading.Event()
+    stop.set()
+    config = dict(CONFIG, mqtt={})
+    run_daemon(ElsterBus(config, simulate=True), Publisher(DummyMqttClient(), config), {"FOO": 60}, stop=stop)
+    assert [signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)] == handlers
+
+
+def test_run_daemon_no_names():
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+    config = dict(CONFIG, mqtt={})
+    run_daemon(ElsterBus(config, simulate=True), Publisher(DummyMqttClient(), config), {}, stop=stop)
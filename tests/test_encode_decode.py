@@ -1,9 +1,18 @@
+import time
+
 import pytest
 
 from src.elster2mqtt.elster2mqtt import (ElsterDataByte2Error,
                                          ElsterDataSizeError,
+                                         ElsterError,
+                                         ElsterInvalidFormat,
+                                         ElsterValue,
                                          decode_elster_data,
-                                         encode_elster_data)
+                                         decode_elster_frame,
+                                         encode_elster_data,
+                                         encode_elster_frame,
+                                         get_format,
+                                         make_format)
 
 
 def test_encode_request_ok():
@@ -39,3 +48,114 @@ def test_decode_size_error():
 def test_decode_byte2_error():
     with pytest.raises(ElsterDataByte2Error):
         decode_elster_data([0, 0, 0, 0, 0, 0, 0])
+
+
+def test_decode_frame_long():
+    assert decode_elster_frame(bytes([0x21, 0x23, 0xfa, 0xde, 0xaf])) == (0x1, 0x0123, 0xdeaf, None)
+    assert decode_elster_frame(bytes([0x22, 0x23, 0xfa, 0xde, 0xaf, 0xba, 0xbe])) == (0x2, 0x0123, 0xdeaf, 0xbabe)
+
+
+def test_decode_frame_short():
+    assert decode_elster_frame(bytes([0x21, 0x23, 0x0c])) == (0x1, 0x0123, 0x0c, None)
+    assert decode_elster_frame(bytes([0x22, 0x23, 0x0c, 0x00, 0xd7])) == (0x2, 0x0123, 0x0c, 0xd7)
+    assert decode_elster_frame(bytes([0x92, 0x00, 0x0c, 0x00, 0xd7, 0x00, 0x00])) == (0x2, 0x0480, 0x0c, 0xd7)
+
+
+def test_decode_frame_invalid():
+    assert decode_elster_frame(b"") is None
+    assert decode_elster_frame(bytes([0x22, 0x23, 0xfa, 0xde])) is None
+    assert decode_elster_frame(bytes([0x22, 0x23, 0x0c, 0x00])) is None
+    assert decode_elster_frame([0x22, 0x23, 0xfa, 0xde, 0x100, 0xba, 0xbe]) is None
+
+
+def test_decode_frame_list():
+    assert decode_elster_frame([0x22, 0x23, 0xfa, 0xde, 0xaf, 0xba, 0xbe]) == (0x2, 0x0123, 0xdeaf, 0xbabe)
+    assert decode_elster_frame(encode_elster_data(0x0123, 0xdeaf)) == (0x1, 0x0123, 0xdeaf, None)
+
+
+FRAMES = [
+    # Responses, long and short form
+    bytes([0x22, 0x23, 0xfa, 0xde, 0xaf, 0xba, 0xbe]),
+    bytes([0x32, 0x00, 0xfa, 0x00, 0x0c, 0x00, 0x8c]),
+    bytes([0x22, 0x23, 0x0c, 0x00, 0xd7]),
+    bytes([0x92, 0x00, 0x0c, 0x00, 0xd7, 0x00, 0x00]),
+    # Requests and other traffic
+    bytes([0x31, 0x00, 0xfa, 0x01, 0xd7]),
+    bytes([0x31, 0x00, 0x0c]),
+    bytes([0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]),
+]
+
+
+def decode_with_exceptions(data):
+    try:
+        return decode_elster_data(data)
+    except ElsterError:
+        return None
+
+
+def frames_per_second(decode, frames, count=20000):
+    start = time.perf_counter()
+    for i in range(count):
+        decode(frames[i % len(frames)])
+    return count / (time.perf_counter() - start)
+
+
+def test_benchmark_decode_frame():
+    before = frames_per_second(decode_with_exceptions, FRAMES)
+    after = frames_per_second(decode_elster_frame, FRAMES)
+    print(f"Frames decoded per second: {before:.0f} decode_elster_data, {after:.0f} decode_elster_frame")
+
+
+def test_encode_frame():
+    assert encode_elster_frame(0x0123, 0xdeaf) == bytes([0x21, 0x23, 0xfa, 0xde, 0xaf])
+    assert encode_elster_frame(0x0123, 0xdeaf, 0xbabe) == bytes([0x22, 0x23, 0xfa, 0xde, 0xaf, 0xba, 0xbe])
+
+
+def test_decode_frame_memoryview():
+    data = memoryview(bytearray([0x22, 0x23, 0xfa, 0xde, 0xaf, 0xba, 0xbe]))
+    assert decode_elster_frame(data) == (0x2, 0x0123, 0xdeaf, 0xbabe)
+
+
+def calls_per_second(func, args, count=20000):
+    start = time.perf_counter()
+    for i in range(count):
+        func(*args[i % len(args)])
+    return count / (time.perf_counter() - start)
+
+
+def test_benchmark_struct():
+    # python-can converts the data of a message to a bytearray
+    encode_args = [(0x180, r) for r in range(16)] + [(0x180, r, r) for r in range(16)]
+    before = calls_per_second(lambda *a: bytearray(encode_elster_data(*a)), encode_args)
+    after = calls_per_second(encode_elster_frame, encode_args)
+    print(f"Frames encoded per second: {before:.0f} encode_elster_data, {after:.0f} encode_elster_frame")
+
+    decode_args = [(bytearray(encode_elster_data(0x680, r, r)),) for r in range(16)]
+    before = calls_per_second(decode_elster_data, decode_args)
+    after = calls_per_second(decode_elster_frame, decode_args)
+    print(f"Frames decoded per second: {before:.0f} decode_elster_data, {after:.0f} decode_elster_frame")
+
+
+def test_value_from_frame():
+    v = ElsterValue.from_frame(0x180, bytes([0x42, 0x00, 0xfa, 0x00, 0x0c, 0x00, 0xd7]), timestamp=1.5)
+    assert (v.type, v.sender, v.receiver, v.register, v.value, v.timestamp) == (0x2, 0x180, 0x200, 0x0c, 0xd7, 1.5)
+    assert v.with_format("dec_val").formatted_value == 21.5
+    assert v.formatted_value == 0xd7
+    assert not hasattr(v, "__dict__")
+    assert ElsterValue.from_frame(0x180, bytes([0x42, 0x00])) is None
+
+
+def test_formats():
+    assert get_format("signed_dec_val")(0xff38) == -20.0
+    assert get_format("signed_dec_val")(0x00c8) == 20.0
+    assert get_format("little_endian")(0x1234) == 0x3412
+    assert get_format(None) is None
+    with pytest.raises(ElsterInvalidFormat):
+        get_format("foo")
+
+
+def test_make_format():
+    assert make_format({"signed": "true", "scale": "0.5", "offset": "1"})(0xfffe) == 0.0
+    assert make_format({"enum": {"1": "EIN", "0": "AUS"}})(1) == "EIN"
+    assert make_format({"enum": {"1": "EIN"}})(7) == 7
+    assert make_format({"base": "little_endian", "bits": {"0": "A", "9": "B"}})(0x0100) == ["A"]
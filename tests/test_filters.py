@@ -0,0 +1,70 @@
+import os
+
+import can
+import yaml
+
+from src.elster2mqtt.elster2mqtt import ElsterBus, encode_elster_data
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), "..", "etc", "elster2mqtt.yaml")
+
+MANAGER = 0x100
+DISPLAY = 0x301
+
+
+def load_config():
+    with open(CONFIG_FILE, "r") as fh:
+        config = yaml.load(fh, Loader=yaml.BaseLoader)
+    config["can"]["interface"] = "test_filters"
+    return config
+
+
+def virtual_bus(**kwargs):
+    kwargs["interface"] = "virtual"
+    return can.interface.Bus(**kwargs)
+
+
+def send_cycle(bus, elster):
+    """Send one polling cycle worth of traffic, including other bus masters"""
+    for reg in elster.registers.values():
+        receiver, register = reg.receiver, reg.register
+        # The heat pump manager and the display poll the same registers
+        for master in (MANAGER, DISPLAY):
+            bus.send(can.Message(arbitration_id=master, data=encode_elster_data(receiver, register),
+                                 is_extended_id=False))
+            bus.send(can.Message(arbitration_id=receiver, data=encode_elster_data(master, register, 1),
+                                 is_extended_id=False))
+        # Our own request and its response
+        bus.send(can.Message(arbitration_id=elster.sender, data=encode_elster_data(receiver, register),
+                             is_extended_id=False))
+        bus.send(can.Message(arbitration_id=receiver, data=encode_elster_data(elster.sender, register, 1),
+                             is_extended_id=False))
+    # The display's own responses
+    for register in range(16):
+        bus.send(can.Message(arbitration_id=DISPLAY, data=encode_elster_data(MANAGER, register, 1),
+                             is_extended_id=False))
+
+
+def frames_per_cycle(monkeypatch, filtered):
+    monkeypatch.setattr(can, "Bus", virtual_bus)
+    config = load_config()
+    elster = ElsterBus(config)
+    if not filtered:
+        monkeypatch.setattr(elster, "can_filters", lambda: None)
+
+    with elster, can.interface.Bus(interface="virtual", channel=elster.channel) as bus:
+        # Use a final response as the end-of-cycle marker
+        fut = elster.dispatcher.expect(0x180, 0xffff)[0]
+        send_cycle(bus, elster)
+        bus.send(can.Message(arbitration_id=0x180, data=encode_elster_data(elster.sender, 0xffff, 0),
+                             is_extended_id=False))
+        fut.result(timeout=5)
+    return elster.dispatcher.frames
+
+
+def test_benchmark_can_filters(monkeypatch):
+    before = frames_per_cycle(monkeypatch, filtered=False)
+    after = frames_per_cycle(monkeypatch, filtered=True)
+    print(f"Frames processed per cycle: {before} unfiltered, {after} filtered")
+    assert after < before
+    # Requests from the other masters and the display's traffic are dropped
+    assert before - after == 3 * 14 + 16
@@ -0,0 +1,136 @@
+import json
+
+import can
+import pytest
+
+from src.elster2mqtt.elster2mqtt import (ChangeFilter,
+                                         DerivedValues,
+                                         ElsterBus,
+                                         ElsterInvalidExpression,
+                                         Publisher,
+                                         encode_elster_data,
+                                         poll,
+                                         start_sniffing)
+
+
+class DummyMqttClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, value):
+        self.published.append((topic, value))
+
+
+def make_config(**mqtt):
+    return {
+        "mqtt": mqtt,
+        "can": {"interface": "dummy", "sender": "123"},
+        "data": [
+            {"name": "FOO", "index": "180.0001", "format": "dec_val"},
+            {"name": "BAR", "index": "180.0002"},
+        ],
+    }
+
+
+def test_poll_snapshot():
+    config = make_config()
+    mqttc = DummyMqttClient()
+    poll(ElsterBus(config, simulate=True), Publisher(mqttc, config))
+    assert mqttc.published == [("info", json.dumps({"foo": 1234.5, "bar": 12345}))]
+
+
+def test_poll_stream():
+    config = make_config(stream="true", snapshot="false")
+    mqttc = DummyMqttClient()
+    poll(ElsterBus(config, simulate=True), Publisher(mqttc, config))
+    assert mqttc.published == [("foo", 1234.5), ("bar", 12345)]
+
+
+def test_change_filter(tmp_path):
+    config = make_config()
+    config["data"][0].update(deadband="0.5", max_interval="60")
+    config["data"][1].update(deadband="10%")
+    state_file = str(tmp_path / "state.json")
+
+    changes = ChangeFilter(config, state_file=state_file)
+    assert changes.changed("FOO", 20.0, now=0)
+    assert not changes.changed("FOO", 20.5, now=10)
+    assert changes.changed("FOO", 20.6, now=20)
+    # Heartbeat
+    assert not changes.changed("FOO", 20.6, now=70)
+    assert changes.changed("FOO", 20.6, now=80)
+
+    assert changes.changed("BAR", 100, now=0)
+    assert not changes.changed("BAR", 110, now=0)
+    assert changes.changed("BAR", 111, now=0)
+
+    # Unfiltered names always pass
+    assert changes.changed("BAZ", 1)
+    assert changes.changed("BAZ", 1)
+
+    # The last published values survive between runs
+    changes.save()
+    changes = ChangeFilter(config, state_file=state_file)
+    assert not changes.changed("FOO", 20.6, now=100)
+    assert changes.changed("BAR", 0, now=100)
+
+
+def test_poll_changes():
+    config = make_config(stream="true")
+    config["data"][0].update(deadband="0")
+    config["data"][1].update(deadband="0")
+    mqttc = DummyMqttClient()
+    publisher = Publisher(mqttc, config, changes=ChangeFilter(config))
+    elster = ElsterBus(config, simulate=True)
+    poll(elster, publisher)
+    assert len(mqttc.published) == 3
+    poll(elster, publisher)
+    assert len(mqttc.published) == 3
+
+
+def test_sniff():
+    config = make_config()
+    mqttc = DummyMqttClient()
+    elster = ElsterBus(config)
+    start_sniffing(elster, Publisher(mqttc, config))
+    # Response from the heat pump to the manager
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x100, 0x0001, 215)))
+    # Response for a name that isn't configured
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x100, 0x0003, 1)))
+    assert mqttc.published == [("foo", 21.5)]
+
+
+def test_derived_values():
+    derived = DerivedValues({"data": [], "derived": [
+        {"name": "SPREIZUNG", "expr": "VORLAUF - RUECKLAUF", "digits": "1"},
+        {"name": "DOPPELT", "expr": "abs(SPREIZUNG) * 2"},
+    ]}, names=["VORLAUF", "RUECKLAUF", "AUSSEN"])
+    assert derived.update("VORLAUF", 35.2) == []
+    assert derived.update("RUECKLAUF", 30.1) == [("SPREIZUNG", 5.1), ("DOPPELT", 10.2)]
+    # Unchanged inputs and unrelated names don't trigger any evaluation
+    assert derived.update("RUECKLAUF", 30.1) == []
+    assert derived.update("AUSSEN", 1.0) == []
+    assert derived.update("VORLAUF", 25.1) == [("SPREIZUNG", -5.0), ("DOPPELT", 10.0)]
+
+
+def test_derived_values_invalid():
+    config = make_config()
+    with pytest.raises(ElsterInvalidExpression):
+        DerivedValues(dict(config, derived=[{"name": "X", "expr": "__import__('os')"}]))
+    with pytest.raises(ElsterInvalidExpression):
+        DerivedValues(dict(config, derived=[{"name": "X", "expr": "FOO.real"}]))
+    with pytest.raises(ElsterInvalidExpression):
+        DerivedValues(dict(config, derived=[{"name": "X", "expr": "Y + 1"}, {"name": "Y", "expr": "X + 1"}]))
+    # Misspelled inputs
+    with pytest.raises(ElsterInvalidExpression, match="Unknown input: FO"):
+        DerivedValues(dict(config, derived=[{"name": "X", "expr": "FO + BAR"}]))
+
+
+def test_poll_derived():
+    config = make_config(stream="true", snapshot="false")
+    config["derived"] = [{"name": "SUMME", "expr": "FOO + BAR"}]
+    mqttc = DummyMqttClient()
+    poll(ElsterBus(config, simulate=True), Publisher(mqttc, config, derived=DerivedValues(config)))
+    assert mqttc.published == [("foo", 1234.5), ("bar", 12345), ("summe", 13579.5)]
@@ -1,6 +1,16 @@
+import queue
+import time
+
 import can
+import pytest
 
-from src.elster2mqtt.elster2mqtt import (ElsterBus,
+from src.elster2mqtt.elster2mqtt import (FORMATS,
+                                         ElsterBus,
+                                         ElsterInvalidFormat,
+                                         ElsterReadTimedOut,
+                                         ElsterReceiverUnavailable,
+                                         ElsterValue,
+                                         ReceiverHealth,
                                          TYPE_REQUEST,
                                          TYPE_RESPONSE,
                                          decode_elster_data,
@@ -8,42 +18,286 @@ from src.elster2mqtt.elster2mqtt import (ElsterBus,
 
 
 class DummyCanBus:
-    def __init__(self, sender, receiver, register, value):
-        self.sender = sender
-        self.receiver = receiver
-        self.register = register
-        self.value = value
+    """Dummy CAN bus that answers read requests from a register map"""
+    channel_info = "dummy"
 
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        data = encode_elster_data(self.sender, self.register, self.value)
-        return can.Message(arbitration_id=self.receiver, data=data)
+    def __init__(self, sender, registers):
+        self.sender = sender
+        self.registers = registers
+        self.rx = queue.Queue()
+        self.sent = []
 
     def send(self, msg):
         msg_type, receiver, register, value = decode_elster_data(msg.data, size=5)
+        assert msg.arbitration_id == self.sender
         assert msg_type == TYPE_REQUEST
-        assert receiver == self.receiver
-        assert register == self.register
         assert value is None
+        self.sent.append((receiver, register))
+        if (receiver, register) in self.registers:
+            data = encode_elster_data(self.sender, register, self.registers[(receiver, register)])
+            self.rx.put(can.Message(arbitration_id=receiver, data=data))
+
+    def recv(self, timeout=None):
+        try:
+            return self.rx.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_filters(self, filters=None):
+        self.filters = filters
+
+    def fileno(self):
+        raise NotImplementedError
 
+    def shutdown(self):
+        pass
 
-def test_read():
-    config = {
-        "can": {
-            "interface": "dummy",
-            "sender": "123",
-        },
-        "data": [
-            {"name": "FOO", "index": "180.deaf", "format": None},
-        ],
-    }
-    elster = ElsterBus(config)
-    elster.bus = DummyCanBus(sender=0x123, receiver=0x180, register=0xdeaf, value=0xdead)
-    msg = elster.read("FOO")
+
+CONFIG = {
+    "can": {
+        "interface": "dummy",
+        "sender": "123",
+    },
+    "data": [
+        {"name": "FOO", "index": "180.deaf", "format": None},
+        {"name": "BAR", "index": "180.0001", "format": "dec_val"},
+        {"name": "BAZ", "index": "301.0002", "format": None},
+    ],
+}
+
+REGISTERS = {
+    (0x180, 0xdeaf): 0xdead,
+    (0x180, 0x0001): 215,
+    (0x301, 0x0002): 7,
+}
+
+
+@pytest.fixture
+def dummy(monkeypatch):
+    bus = DummyCanBus(sender=0x123, registers=dict(REGISTERS))
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: bus)
+    return bus
+
+
+def test_read(dummy):
+    with ElsterBus(CONFIG) as elster:
+        msg = elster.read("FOO")
     assert msg.type == TYPE_RESPONSE
     assert msg.sender == 0x180
     assert msg.receiver == 0x123
     assert msg.register == 0xdeaf
     assert msg.value == 0xdead
+
+
+def test_read_many(dummy):
+    with ElsterBus(CONFIG) as elster:
+        msgs = elster.read_many(["FOO", "BAR", "BAZ"], window=2)
+    assert msgs["FOO"].value == 0xdead
+    assert msgs["BAR"].formatted_value == 21.5
+    assert msgs["BAZ"].sender == 0x301
+    assert dummy.sent == [(0x180, 0xdeaf), (0x180, 0x0001), (0x301, 0x0002)]
+
+
+def test_read_many_timeout(dummy):
+    dummy.registers = {(0x180, 0xdeaf): 0xdead}
+    with ElsterBus(CONFIG) as elster:
+        msgs = elster.read_many(["FOO", "BAR"], timeout=0.1)
+    assert list(msgs) == ["FOO"]
+
+
+def test_read_circuit_breaker(dummy):
+    dummy.registers = {(0x301, 0x0002): 7}
+    config = dict(CONFIG, can=dict(CONFIG["can"], breaker_threshold="2", breaker_reset="0.2"))
+    with ElsterBus(config) as elster:
+        for _ in range(2):
+            with pytest.raises(ElsterReadTimedOut):
+                elster.read("FOO", timeout=0.05)
+        assert not elster.receiver_health(0x180).available
+
+        # Reads from the unavailable receiver fail fast and don't hit the bus
+        sent = len(dummy.sent)
+        with pytest.raises(ElsterReceiverUnavailable):
+            elster.read("FOO")
+        msgs = elster.read_many(["FOO", "BAR", "BAZ"])
+        assert list(msgs) == ["BAZ"]
+        assert dummy.sent[sent:] == [(0x301, 0x0002)]
+
+        # A successful probe restores the receiver
+        time.sleep(0.2)
+        dummy.registers[(0x180, 0xdeaf)] = 0xdead
+        assert elster.read("FOO").value == 0xdead
+        assert elster.receiver_health(0x180).available
+
+
+def test_read_out_of_order():
+    elster = ElsterBus(CONFIG)
+    foo = elster.dispatcher.expect(0x180, 0xdeaf)[0]
+    bar = elster.dispatcher.expect(0x180, 0x0001)[0]
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x123, 0x0001, 215)))
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x123, 0xdeaf, 0xdead)))
+    assert foo.result(timeout=0).value == 0xdead
+    assert bar.result(timeout=0).value == 215
+
+
+def test_dispatch_unmatched():
+    elster = ElsterBus(CONFIG)
+    seen = []
+    elster.dispatcher.subscribe(seen.append)
+    # Response to another bus master
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x700, 0x000c, 42)))
+    assert elster.dispatcher.cached(0x180, 0x000c, max_age=60).value == 42
+    assert [(m.sender, m.receiver, m.value) for m in seen] == [(0x180, 0x700, 42)]
+
+
+def test_adaptive_timeout():
+    health = ReceiverHealth(timeout_min=0.05, timeout_max=30)
+    assert health.timeout == 1
+    health.failure(0)
+    assert health.timeout == 2
+    health.success()
+    for _ in range(20):
+        health.success(0.02)
+    assert health.timeout == 0.05
+    health.success(0.2)
+    assert 0.05 < health.timeout < 0.5
+    timeout = health.timeout
+    health.failure(0)
+    assert health.timeout == 2 * timeout
+
+
+def test_initial_timeout():
+    assert ElsterBus(CONFIG).receiver_health(0x180).timeout == 1
+    config = dict(CONFIG, can=dict(CONFIG["can"], timeout_initial="0.5"))
+    assert ElsterBus(config).receiver_health(0x180).timeout == 0.5
+
+
+def test_read_adaptive_timeout(dummy):
+    with ElsterBus(CONFIG) as elster:
+        elster.read_many(["FOO", "BAR"])
+        health = elster.receiver_health(0x180)
+        assert health.srtt is not None
+        assert health.timeout < 30
+
+
+def test_read_many_cached(dummy):
+    config = dict(CONFIG, data=[dict(CONFIG["data"][0], max_age="60"), *CONFIG["data"][1:]])
+    with ElsterBus(config) as elster:
+        # Response to another bus master
+        elster.dispatcher.on_message_received(
+            can.Message(arbitration_id=0x180, data=encode_elster_data(0x700, 0xdeaf, 0xbeef)))
+        msgs = elster.read_many(["FOO", "BAR"])
+    assert msgs["FOO"].value == 0xbeef
+    assert msgs["BAR"].value == 215
+    assert dummy.sent == [(0x180, 0x0001)]
+
+
+def test_read_many_own_response_not_cached(dummy):
+    dummy.registers = {(0x180, 0xdeaf): 0xdead}
+    config = dict(CONFIG, data=[dict(CONFIG["data"][0], max_age="60"), *CONFIG["data"][1:]])
+    with ElsterBus(config) as elster:
+        assert elster.read_many(["FOO"])["FOO"].value == 0xdead
+        dummy.registers[(0x180, 0xdeaf)] = 0xbeef
+        assert elster.read_many(["FOO"])["FOO"].value == 0xbeef
+    assert dummy.sent == [(0x180, 0xdeaf)] * 2
+
+
+def test_registers():
+    elster = ElsterBus(CONFIG)
+    reg = elster.registers["BAR"]
+    assert (reg.receiver, reg.register, reg.fmt) == (0x180, 0x0001, "dec_val")
+    assert reg.request.arbitration_id == 0x123
+    assert bytes(reg.request.data) == bytes(encode_elster_data(0x180, 0x0001))
+    assert elster.index[(0x301, 0x0002)] == "BAZ"
+
+
+def test_read_composite(dummy):
+    dummy.registers.update({(0x180, 0x092f): 345, (0x180, 0x0930): 12})
+    config = dict(CONFIG, composites=[
+        {"name": "ENERGIE", "parts": ["180.092f", {"index": "180.0930"}], "combine": "kwh_mwh"},
+    ])
+    with ElsterBus(config) as elster:
+        assert elster.names == ["FOO", "BAR", "BAZ", "ENERGIE"]
+        assert elster.read("ENERGIE").value == 12345
+        msgs = elster.read_many(["FOO", "ENERGIE"])
+    assert msgs["ENERGIE"].value == 12345
+    assert msgs["FOO"].value == 0xdead
+    # The parts are requested back to back
+    assert dummy.sent[-2:] == [(0x180, 0x092f), (0x180, 0x0930)]
+
+
+class HoldingCanBus(DummyCanBus):
+    """Dummy CAN bus that holds back all responses until 'count' requests were sent"""
+    def __init__(self, sender, registers, count):
+        super().__init__(sender, registers)
+        self.count = count
+        self.held = queue.Queue()
+
+    def send(self, msg):
+        rx, self.rx = self.rx, self.held
+        super().send(msg)
+        self.rx = rx
+        if len(self.sent) >= self.count:
+            while not self.held.empty():
+                self.rx.put(self.held.get())
+
+
+def test_read_composite_exceeds_window(monkeypatch):
+    registers = {**REGISTERS, (0x180, 0x092f): 345, (0x180, 0x0930): 12}
+    bus = HoldingCanBus(sender=0x123, registers=registers, count=2)
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: bus)
+    config = dict(CONFIG, composites=[{"name": "ENERGIE", "parts": ["180.092f", "180.0930"], "combine": "kwh_mwh"}])
+    with ElsterBus(config) as elster:
+        # Both parts are sent before any response, despite the window of 1
+        msgs = elster.read_many(["ENERGIE"], window=1, timeout=0.5)
+    assert msgs["ENERGIE"].value == 12345
+
+
+def test_read_composite_timeout(dummy):
+    config = dict(CONFIG, composites=[{"name": "ENERGIE", "parts": ["180.deaf", "180.0fff"]}])
+    with ElsterBus(config) as elster:
+        assert elster.read_many(["ENERGIE", "BAR"], timeout=0.1).keys() == {"BAR"}
+
+
+def test_overheard():
+    elster = ElsterBus(CONFIG)
+    elster.dispatcher.on_message_received(
+        can.Message(arbitration_id=0x180, data=encode_elster_data(0x700, 0x0001, 215)))
+    assert elster.overheard("BAR", 60).value == 215
+    assert elster.overheard("FOO", 60) is None
+    assert elster.overheard("UNKNOWN", 60) is None
+
+
+def test_config_formats():
+    config = dict(CONFIG, formats={"onoff": {"enum": {"0": "AUS", "1": "EIN"}}},
+                  data=[{"name": "FOO", "index": "180.0001", "format": "onoff"}])
+    elster = ElsterBus(config, simulate=True)
+    assert elster.registers["FOO"].convert(1) == "EIN"
+    # Config formats are private to the bus
+    assert "onoff" not in FORMATS
+    value = ElsterValue(0x180, 0x123, 0x0001, 1)
+    assert value.with_format("onoff", elster.formats).formatted_value == "EIN"
+    with pytest.raises(ElsterInvalidFormat):
+        value.with_format("onoff")
+    with pytest.raises(ElsterInvalidFormat):
+        ElsterBus(dict(config, formats={"dec_val": {"scale": "0.01"}}))
+
+
+def test_formatted_value_uses_converter(dummy):
+    config = dict(CONFIG, formats={"centi": {"scale": "0.01"}},
+                  data=[{"name": "BAR", "index": "180.0001", "format": "centi"}])
+    with ElsterBus(config) as elster:
+        msg = elster.read_many(["BAR"])["BAR"]
+    assert msg.convert is elster.registers["BAR"].convert
+    assert msg.formatted_value == 2.15
+
+
+def test_read_many_shared_register(dummy):
+    config = dict(CONFIG, composites=[{"name": "SUMME", "parts": ["180.deaf", "180.0001"]}])
+    with ElsterBus(config) as elster:
+        msgs = elster.read_many(["FOO", "SUMME"])
+    assert msgs.keys() == {"FOO", "SUMME"}
+    assert msgs["FOO"].value == 0xdead
+    assert msgs["SUMME"].value == 0xdead + 215
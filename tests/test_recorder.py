@@ -0,0 +1,84 @@
+import can
+import pytest
+
+from src.elster2mqtt.elster2mqtt import ElsterBus, encode_elster_frame
+from src.elster2mqtt.recorder import RECORD, FrameLog, FrameRecorder
+from src.elster2mqtt.simulator import ElsterSimulator
+
+from .test_read import REGISTERS, DummyCanBus
+from .test_read import CONFIG as READ_CONFIG
+
+CONFIG = {
+    "can": {"interface": "test_recorder", "sender": "680"},
+    "data": [{"name": "WW_SOLL", "index": "180.0003", "format": "dec_val"}],
+    "simulator": {"latency": "0", "registers": {"180.0003": {"value": "480"}}},
+}
+
+
+def message(timestamp, receiver, register, value=None):
+    return can.Message(timestamp=timestamp, arbitration_id=receiver, data=encode_elster_frame(0x680, register, value),
+                       is_extended_id=False)
+
+
+def test_record_size():
+    assert RECORD.size == 24
+
+
+def test_frame_log(tmp_path):
+    path = tmp_path / "frames.bin"
+    with FrameRecorder(path) as recorder:
+        for i in range(100):
+            recorder.record(message(1000 + i, 0x180, i, i))
+        recorder.record(message(2000, 0x180, 0x0003))
+
+    with FrameLog(path) as log:
+        assert len(log) == 101
+        msg = log[5]
+        assert msg.timestamp == 1005
+        assert msg.arbitration_id == 0x180
+        assert bytes(msg.data) == encode_elster_frame(0x680, 5, 5)
+        assert log[-1].dlc == 5
+        with pytest.raises(IndexError):
+            log[101]
+
+        assert log.bisect(0) == 0
+        assert log.bisect(1050) == 50
+        assert log.bisect(1050.5) == 51
+        assert log.bisect(3000) == 101
+        assert [m.timestamp for m in log.between(1097, 1500)] == [1097, 1098, 1099]
+
+
+def test_frame_log_partial_and_empty(tmp_path):
+    path = tmp_path / "frames.bin"
+    path.write_bytes(b"")
+    with FrameLog(path) as log:
+        assert len(log) == 0
+        assert list(log) == []
+
+    path.write_bytes(RECORD.pack(1.0, 0x180, 0, b"") + b"\x00" * 10)
+    with FrameLog(path) as log:
+        assert len(log) == 1
+
+
+def test_elster_bus_recording(tmp_path):
+    path = tmp_path / "frames.bin"
+    with FrameRecorder(path) as recorder:
+        with ElsterSimulator(CONFIG), ElsterBus(CONFIG, interface="virtual", recorder=recorder) as elster:
+            assert elster.read("WW_SOLL", timeout=5).value == 480
+
+    with FrameLog(path) as log:
+        assert [m.arbitration_id for m in log] == [0x680, 0x180]
+        assert log[0].timestamp <= log[1].timestamp
+
+
+def test_request_recorded_before_sending(tmp_path, monkeypatch):
+    class CheckingCanBus(DummyCanBus):
+        def send(self, msg):
+            # The response must not be able to overtake the request in the log
+            assert recorder.frames == 1
+            super().send(msg)
+
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: CheckingCanBus(sender=0x123, registers=dict(REGISTERS)))
+    with FrameRecorder(tmp_path / "frames.bin") as recorder:
+        with ElsterBus(READ_CONFIG, recorder=recorder) as elster:
+            assert elster.read("FOO").value == 0xdead
@@ -0,0 +1,71 @@
+import can
+import pytest
+
+from src.elster2mqtt.elster2mqtt import ElsterBus, Publisher, encode_elster_frame
+from src.elster2mqtt.recorder import FrameLog, FrameRecorder
+from src.elster2mqtt.replay import open_log, replay, run_replay
+
+from .test_publish import DummyMqttClient
+
+CONFIG = {
+    "mqtt": {"stream": "true", "snapshot": "false"},
+    "can": {"interface": "dummy", "sender": "680"},
+    "data": [{"name": "WW_SOLL", "index": "180.0003", "format": "dec_val"}],
+}
+
+
+def frames():
+    # A request and response of another bus master, an unknown register and our own read
+    return [
+        can.Message(timestamp=100.0, arbitration_id=0x100, data=encode_elster_frame(0x180, 0x0003),
+                    is_extended_id=False),
+        can.Message(timestamp=100.5, arbitration_id=0x180, data=encode_elster_frame(0x100, 0x0003, 480),
+                    is_extended_id=False),
+        can.Message(timestamp=101.0, arbitration_id=0x180, data=encode_elster_frame(0x100, 0x0004, 1),
+                    is_extended_id=False),
+        can.Message(timestamp=102.0, arbitration_id=0x180, data=encode_elster_frame(0x680, 0x0003, 490),
+                    is_extended_id=False),
+    ]
+
+
+def run(path):
+    mqttc = DummyMqttClient()
+    count = run_replay(ElsterBus(CONFIG, simulate=True), Publisher(mqttc, CONFIG), str(path), speed=0)
+    assert count == 4
+    return mqttc.published
+
+
+def test_replay_timing():
+    class Listener(can.Listener):
+        def __init__(self):
+            self.received = []
+
+        def on_message_received(self, msg):
+            self.received.append(msg)
+
+    delays = []
+    listener = Listener()
+    assert replay(frames(), listener, speed=0, sleep=delays.append) == 4
+    assert delays == []
+
+    replay(frames(), listener, speed=2, sleep=delays.append)
+    assert len(listener.received) == 8
+    assert delays == pytest.approx([0.25, 0.5, 1.0], abs=0.05)
+
+
+def test_replay_frame_log(tmp_path):
+    path = tmp_path / "frames.bin"
+    with FrameRecorder(path) as recorder:
+        for msg in frames():
+            recorder.record(msg)
+    assert isinstance(open_log(str(path)), FrameLog)
+    assert run(path) == [("ww_soll", 48.0), ("ww_soll", 49.0)]
+
+
+def test_replay_can_logs(tmp_path):
+    for name in ("frames.asc", "frames.log", "frames.blf"):
+        path = tmp_path / name
+        with can.Logger(str(path)) as logger:
+            for msg in frames():
+                logger.on_message_received(msg)
+        assert run(path) == [("ww_soll", 48.0), ("ww_soll", 49.0)]
@@ -0,0 +1,57 @@
+import io
+import json
+
+import can
+import pytest
+
+from src.elster2mqtt.elster2mqtt import ElsterBus
+from src.elster2mqtt.scan import NO_VALUE, ElsterScanner, parse_scan_range
+
+from .test_read import CONFIG, DummyCanBus
+
+
+@pytest.fixture
+def dummy(monkeypatch):
+    registers = {(0x180, r): NO_VALUE for r in range(0x20)}
+    registers.update({(0x180, 0x0003): 3, (0x180, 0x0011): 17, (0x301, 0x0002): 2})
+    bus = DummyCanBus(sender=0x123, registers=registers)
+    monkeypatch.setattr(can, "Bus", lambda **kwargs: bus)
+    return bus
+
+
+def test_parse_scan_range():
+    assert parse_scan_range("180") == (0x180, 0x0000, 0xffff)
+    assert parse_scan_range("180.0100") == (0x180, 0x0100, 0x0100)
+    assert parse_scan_range("180.0100-01ff") == (0x180, 0x0100, 0x01ff)
+
+
+def test_scan(dummy, tmp_path):
+    checkpoint = str(tmp_path / "checkpoint.json")
+    out = io.StringIO()
+    with ElsterBus(CONFIG) as elster:
+        elster.receiver_health(0x301).timeout = 0.05
+        scanner = ElsterScanner(elster, [(0x180, 0x00, 0x1f), (0x301, 0x00, 0x03)], out, checkpoint=checkpoint)
+        assert scanner.run() == 3
+    assert out.getvalue().splitlines() == ["180.0003: 3", "180.0011: 17", "301.0002: 2"]
+    with open(checkpoint) as fh:
+        assert json.load(fh) == {"180.0000-001f": 0x20, "301.0000-0003": 0x04}
+
+
+def test_scan_resume(dummy, tmp_path):
+    checkpoint = tmp_path / "checkpoint.json"
+    checkpoint.write_text(json.dumps({"180.0000-001f": 0x10}))
+    out = io.StringIO()
+    with ElsterBus(CONFIG) as elster:
+        scanner = ElsterScanner(elster, [(0x180, 0x00, 0x1f)], out, checkpoint=str(checkpoint))
+        assert scanner.run() == 1
+    assert out.getvalue().splitlines() == ["180.0011: 17"]
+    assert dummy.sent[0] == (0x180, 0x10)
+
+
+def test_scan_ranges_same_receiver(dummy, tmp_path):
+    out = io.StringIO()
+    with ElsterBus(CONFIG) as elster:
+        scanner = ElsterScanner(elster, [(0x180, 0x10, 0x1f), (0x180, 0x00, 0x0f)], out)
+        assert scanner.run() == 2
+    assert out.getvalue().splitlines() == ["180.0011: 17", "180.0003: 3"]
+    assert sorted(dummy.sent) == [(0x180, r) for r in range(0x20)]
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from src.elster2mqtt.elster2mqtt import NO_VALUE, ElsterBus
+from src.elster2mqtt.simulator import ElsterSimulator, Waveform
+
+
+def make_config(channel, **simulator):
+    return {
+        "can": {"interface": channel, "sender": "680", "timeout_max": "1"},
+        "data": [
+            {"name": "AUSSENTEMPERATUR", "index": "180.000c", "format": "signed_dec_val"},
+            {"name": "FEHLER", "index": "180.0001"},
+        ],
+        "simulator": dict({"latency": "0.005", "seed": "1"}, **simulator),
+    }
+
+
+def test_waveform():
+    assert Waveform({"value": "215"})(100) == 215
+    sine = Waveform({"waveform": "sine", "value": "100", "amplitude": "10", "period": "40"})
+    assert (sine(0), sine(10), sine(30)) == (100, 110, 90)
+    ramp = Waveform({"waveform": "ramp", "value": "5", "step": "1", "min": "0", "max": "9"})
+    assert (ramp(0), ramp(4), ramp(5)) == (5, 9, 0)
+    walk = Waveform({"waveform": "random_walk", "value": "50", "step": "5", "min": "0", "max": "100"})
+    assert all(0 <= walk(t) <= 100 for t in range(100))
+    # Negative values are two's complement
+    assert Waveform({"value": "-20"})(0) == 0xffec
+    with pytest.raises(ValueError):
+        Waveform({"waveform": "square"})
+
+
+def test_simulator_read():
+    config = make_config("test_simulator_read", registers={"180.000c": {"value": "-55"}})
+    with ElsterSimulator(config) as sim, ElsterBus(config, interface="virtual") as elster:
+        msgs = elster.read_many(["AUSSENTEMPERATUR", "FEHLER"])
+        assert msgs["AUSSENTEMPERATUR"].formatted_value == -5.5
+        assert msgs["FEHLER"].value == 0
+        assert elster.read(receiver=0x180, register=0x1234).value == NO_VALUE
+        assert sim.requests == 3
+
+
+def test_simulator_loss():
+    config = make_config("test_simulator_loss", loss="1")
+    with ElsterSimulator(config), ElsterBus(config, interface="virtual") as elster:
+        assert elster.read_many(["FEHLER"], timeout=0.1) == {}
+
+
+def test_simulator_traffic():
+    config = make_config("test_simulator_traffic", traffic="200")
+    with ElsterSimulator(config), ElsterBus(config, interface="virtual") as elster:
+        time.sleep(0.1)
+        assert elster.dispatcher.cached(0x180, 0x000c, max_age=1).receiver == 0x100